@@ -0,0 +1,85 @@
+"""
+Micro-benchmark of the hand blending kernel (draw_hand_on_img).
+
+Compares the old float64 per-channel blend with the uint8 OpenCV kernel on
+the bundled hand and on a soft edged (anti-aliased) mask, and checks that
+both agree within +-1 per channel.
+
+Usage (from the repo root):
+    python benchmarks/bench_hand_blend.py --repeat 2000
+"""
+import os
+import sys
+import argparse
+import timeit
+
+import cv2
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "kivy"))
+import sketchApi
+
+
+def float_blend(drawing, hand, x, y, hand_mask_inv):
+    """ The previous kernel: float64 multiply per channel, then add """
+    ht, wd = hand.shape[:2]
+    roi = drawing[y : y + ht, x : x + wd]
+    for ch in range(3):
+        roi[:, :, ch] = roi[:, :, ch] * hand_mask_inv
+    roi[:] = np.minimum(roi.astype(np.uint16) + hand, 255)
+    return drawing
+
+
+def load_hand(soft_edges):
+    """ Premultiplied hand with the float and the uint8 inverse masks """
+    variables = sketchApi.preprocess_hand_image(
+        sketchApi.hand_path, sketchApi.hand_mask_path, sketchApi.AllVariables()
+    )
+    hand_mask = variables.hand_mask
+    if soft_edges:
+        hand_mask = cv2.GaussianBlur(hand_mask, (9, 9), 0)
+    hand = cv2.imread(sketchApi.hand_path)
+    top_left, bottom_right = sketchApi.get_extreme_coordinates(
+        cv2.imread(sketchApi.hand_mask_path, cv2.IMREAD_GRAYSCALE)
+    )
+    hand = hand[top_left[1] : bottom_right[1], top_left[0] : bottom_right[0]]
+    hand = cv2.multiply(hand, cv2.cvtColor(hand_mask, cv2.COLOR_GRAY2BGR), scale=1 / 255)
+    float_mask_inv = (255 - hand_mask) / 255
+    u8_mask_inv = cv2.cvtColor(255 - hand_mask, cv2.COLOR_GRAY2BGR)
+    return hand, float_mask_inv, u8_mask_inv
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--repeat", type=int, default=1000)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    frame = rng.integers(0, 256, (1080, 1920, 3), dtype=np.uint8)
+    x, y = 700, 300
+    for soft_edges in (False, True):
+        hand, float_mask_inv, u8_mask_inv = load_hand(soft_edges)
+        ht, wd = hand.shape[:2]
+
+        old = float_blend(frame.copy(), hand, x, y, float_mask_inv)
+        new = sketchApi.draw_hand_on_img(frame.copy(), hand, x, y, u8_mask_inv, ht, wd, 1080, 1920)
+        max_diff = int(np.abs(old.astype(np.int16) - new.astype(np.int16)).max())
+
+        work = frame.copy()
+        old_sec = timeit.timeit(lambda: float_blend(work, hand, x, y, float_mask_inv), number=args.repeat)
+        new_sec = timeit.timeit(
+            lambda: sketchApi.draw_hand_on_img(work, hand, x, y, u8_mask_inv, ht, wd, 1080, 1920),
+            number=args.repeat,
+        )
+        label = "soft mask" if soft_edges else "bundled mask"
+        print(
+            f"{label:13s} hand {wd}x{ht}: float64 {old_sec / args.repeat * 1e6:8.1f} us, "
+            f"uint8 {new_sec / args.repeat * 1e6:8.1f} us, speedup {old_sec / new_sec:5.1f}x, "
+            f"max diff {max_diff}"
+        )
+        if max_diff > 1:
+            sys.exit(f"uint8 kernel differs by {max_diff} from the float64 kernel")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,270 @@
+"""
+End-to-end render benchmark of sketchApi.
+
+Renders deterministic synthetic images (and the repo sample image, resized)
+at 480p, 720p, 1080p & 4K over a sweep of split_len, skip rates & draw_hand.
+Every case runs in its own process and times the stages separately with
+sketchApi.RenderStats: preprocess_image, hand loading, planning, drawing,
+encoding and ffmpeg_convert (cv2 encoder only). --track-memory adds the
+memory use of every stage. The results go to a JSON file, which a later
+run can be compared with to flag speed & memory regressions.
+
+Usage (from the repo root):
+    python benchmarks/bench_render.py --out bench.json
+    python benchmarks/bench_render.py --sizes 480p,720p --split-lens 10 --out new.json --compare bench.json
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import tempfile
+import itertools
+from concurrent.futures import ProcessPoolExecutor
+
+import cv2
+import numpy as np
+
+repo_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, os.path.join(repo_path, "kivy"))
+import sketchApi
+
+sizes = {
+    "480p": (640, 480),
+    "720p": (1280, 720),
+    "1080p": (1920, 1080),
+    "4k": (3840, 2160),
+}
+sample_image_path = os.path.join(repo_path, "docs", "images", "thumb.png")
+# the numbers compared with the baseline & whether higher is better
+compare_metrics = {"wall_sec": False, "frames_per_sec": True, "tiles_per_sec": True, "peak_rss_mb": False}
+
+
+def make_synthetic_image(wd, ht, seed=0):
+    """ Line art with some filled shapes & text, the same for the same seed & size """
+    rng = np.random.default_rng(seed)
+    img = np.full((ht, wd, 3), 235, np.uint8)
+    scale = wd / 1280
+    for _ in range(60):
+        color = tuple(int(c) for c in rng.integers(0, 200, 3))
+        center = (int(rng.integers(0, wd)), int(rng.integers(0, ht)))
+        radius = int(rng.integers(10, 90) * scale) + 1
+        if rng.random() < 0.3:
+            cv2.circle(img, center, radius, color, -1)
+        else:
+            cv2.circle(img, center, radius, color, max(1, int(3 * scale)))
+    for _ in range(40):
+        pt1 = (int(rng.integers(0, wd)), int(rng.integers(0, ht)))
+        pt2 = (int(rng.integers(0, wd)), int(rng.integers(0, ht)))
+        cv2.line(img, pt1, pt2, (20, 20, 20), max(1, int(2 * scale)))
+    for i in range(5):
+        org = (int(rng.integers(0, wd // 2)), int(rng.integers(ht // 8, ht)))
+        cv2.putText(img, f"Sketch {i}", org, cv2.FONT_HERSHEY_SIMPLEX, 1.5 * scale, (0, 0, 0), max(1, int(3 * scale)))
+    return img
+
+
+def make_sample_image(wd, ht):
+    img = cv2.imread(sample_image_path)
+    if img is None:
+        return None
+    return cv2.resize(img, (wd, ht), interpolation=cv2.INTER_AREA)
+
+
+def get_peak_rss_mb():
+    try:
+        import resource
+    except ImportError:
+        return None  # Windows
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+
+def run_case(case, work_dir):
+    """ Runs one case, meant to be called in a fresh worker process """
+    wd, ht = sizes[case["size"]]
+    if case["image"] == "sample":
+        img = make_sample_image(wd, ht)
+    else:
+        img = make_synthetic_image(wd, ht)
+
+    variables = sketchApi.AllVariables(
+        frame_rate=25,
+        resize_wd=wd,
+        resize_ht=ht,
+        split_len=case["split_len"],
+        object_skip_rate=case["object_skip_rate"],
+        bg_object_skip_rate=case["bg_skip_rate"],
+        end_gray_img_duration_in_sec=case["end_duration"],
+        draw_hand=case["draw_hand"],
+    )
+    variables.stats = sketchApi.RenderStats(track_memory=case["track_memory"])
+    stats = variables.stats
+    video_path = os.path.join(work_dir, f"bench_{os.getpid()}.mp4")
+    converted_path = os.path.join(work_dir, f"bench_{os.getpid()}_h264.mp4")
+    wall_start = time.perf_counter()
+
+    if case["encoder"] == "av":
+        variables.video_object = sketchApi.AvVideoWriter(video_path, variables.frame_rate, (wd, ht))
+    else:
+        variables.video_object = cv2.VideoWriter(
+            video_path, cv2.VideoWriter_fourcc(*"mp4v"), variables.frame_rate, (wd, ht)
+        )
+    sketchApi.draw_whiteboard_animations(
+        img, None, sketchApi.hand_path, sketchApi.hand_mask_path, video_path, variables, True
+    )
+    if case["encoder"] == "cv2":
+        with stats.stage("convert"):
+            sketchApi.ffmpeg_convert(video_path, converted_path)
+    wall_sec = time.perf_counter() - wall_start
+    stats.stop_memory_tracking()
+
+    for path in (video_path, converted_path):
+        if os.path.exists(path):
+            os.unlink(path)
+    stats_dict = stats.as_dict()
+    stages = stats_dict["stages"]
+    # the draw stage includes the writer calls
+    draw_sec = stages["draw"] - stages["encode"]
+    n_tiles = stats_dict["counters"]["tiles_drawn"]
+    n_frames = stats_dict["counters"]["frames_written"]
+    result = {
+        "case": case,
+        "key": get_case_key(case),
+        "stages": {**stages, "draw": round(draw_sec, 4)},
+        "frames": n_frames,
+        "tiles": n_tiles,
+        "wall_sec": round(wall_sec, 4),
+        "frames_per_sec": round(n_frames / stages["draw"], 2),
+        "tiles_per_sec": round(n_tiles / draw_sec, 1) if draw_sec > 0 else None,
+        "peak_rss_mb": get_peak_rss_mb(),
+    }
+    if case["track_memory"]:
+        result["memory"] = stats_dict["memory"]
+    return result
+
+
+def get_case_key(case):
+    return (
+        f"{case['image']}-{case['size']}-split{case['split_len']}-skip{case['object_skip_rate']}"
+        f"_{case['bg_skip_rate']}-hand{int(case['draw_hand'])}-{case['encoder']}"
+        # tracemalloc slows the render down, only compare like with like
+        + ("-mem" if case.get("track_memory") else "")
+    )
+
+
+def get_cases(args):
+    skip_rates = [tuple(int(x) for x in pair.split(":")) for pair in args.skip_rates.split(",")]
+    cases = []
+    for image, size, split_len, (obj_skip, bg_skip), draw_hand in itertools.product(
+        args.images.split(","),
+        args.sizes.split(","),
+        [int(x) for x in args.split_lens.split(",")],
+        skip_rates,
+        [bool(int(x)) for x in args.hand.split(",")],
+    ):
+        wd, ht = sizes[size]
+        if wd % split_len or ht % split_len:
+            print(f"Skipping {size} with split_len {split_len}, it does not divide the frame")
+            continue
+        cases.append(
+            {
+                "image": image,
+                "size": size,
+                "split_len": split_len,
+                "object_skip_rate": obj_skip,
+                "bg_skip_rate": bg_skip,
+                "draw_hand": draw_hand,
+                "encoder": args.encoder,
+                "end_duration": args.end_duration,
+                "track_memory": args.track_memory,
+            }
+        )
+    return cases
+
+
+def compare_results(results, baseline, threshold):
+    """ Prints the change of every case found in both runs, returns the regressions """
+    baseline_by_key = {result["key"]: result for result in baseline["results"]}
+    regressions = []
+    for result in results:
+        old = baseline_by_key.get(result["key"])
+        if old is None:
+            print(f"{result['key']}: not in the baseline")
+            continue
+        changes = []
+        for metric, higher_is_better in compare_metrics.items():
+            if not old.get(metric) or result.get(metric) is None:
+                continue
+            change = (result[metric] - old[metric]) / old[metric]
+            worse = -change if higher_is_better else change
+            flag = ""
+            if worse > threshold:
+                flag = " REGRESSION"
+                regressions.append((result["key"], metric, change))
+            changes.append(f"{metric} {old[metric]} -> {result[metric]} ({change:+.1%}){flag}")
+        print(f"{result['key']}: " + ", ".join(changes))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", default="480p,720p,1080p,4k", help="comma separated, of " + ",".join(sizes))
+    parser.add_argument("--images", default="synthetic,sample", help="synthetic and/or sample")
+    parser.add_argument("--split-lens", default="10,20")
+    parser.add_argument("--skip-rates", default="8:14", help="object:background pairs, comma separated")
+    parser.add_argument("--hand", default="1,0", help="draw_hand values, comma separated 1/0")
+    parser.add_argument("--encoder", choices=["av", "cv2"], default="av", help="cv2 also times ffmpeg_convert")
+    parser.add_argument("--end-duration", type=int, default=2)
+    parser.add_argument("--track-memory", action="store_true", help="memory use of every stage (slower)")
+    parser.add_argument("--out", help="write the results to this JSON file")
+    parser.add_argument("--compare", help="baseline JSON file from an earlier run")
+    parser.add_argument("--threshold", type=float, default=0.10, help="relative slowdown counted as a regression")
+    args = parser.parse_args(argv)
+
+    if "sample" in args.images.split(",") and not os.path.exists(sample_image_path):
+        sys.exit(f"Sample image is missing: {sample_image_path}")
+    cases = get_cases(args)
+    results = []
+    with tempfile.TemporaryDirectory() as work_dir:
+        for case in cases:
+            # a fresh process per case, so the peak RSS is the one of that case
+            with ProcessPoolExecutor(max_workers=1, mp_context=sketchApi.get_mp_context()) as executor:
+                result = executor.submit(run_case, case, work_dir).result()
+            stages = ", ".join(f"{name} {sec:.3f}" for name, sec in result["stages"].items())
+            print(
+                f"{result['key']}: {result['wall_sec']:.2f} s, {result['frames_per_sec']} fps, "
+                f"{result['tiles_per_sec']} tiles/s, {result['peak_rss_mb']} MB | {stages}"
+            )
+            results.append(result)
+
+    report = {
+        "meta": {
+            "created": time.strftime("%Y-%m-%d %H:%M:%S"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "opencv": cv2.__version__,
+            "numpy": np.__version__,
+        },
+        "results": results,
+    }
+    if args.out:
+        with open(args.out, "w") as file:
+            json.dump(report, file, indent=2)
+        print(f"Results saved to {args.out}")
+
+    if args.compare:
+        with open(args.compare) as file:
+            baseline = json.load(file)
+        regressions = compare_results(results, baseline, args.threshold)
+        if regressions:
+            print(f"{len(regressions)} regression(s) over {args.threshold:.0%}")
+            return 1
+        print("No regressions")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,129 @@
+"""
+Checks that segmented renders (render_segmented) give the same video as a
+serial render of the same image.
+
+Renders a synthetic image once serially and then in several segment
+counts, for a short and a long end hold (the segments that fall inside the
+hold are the tricky ones), and compares the number of frames shown, the
+duration and every decoded frame of the joined video with the serial one.
+Needs PyAV.
+
+Usage (from the repo root):
+    python benchmarks/check_segments.py
+    python benchmarks/check_segments.py --size 720p --segments 2,3,4 --holds 2,5
+"""
+import os
+import sys
+import argparse
+import tempfile
+
+import cv2
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from bench_render import sizes, make_synthetic_image, sketchApi
+
+
+def get_video_timing(video_path, frame_rate):
+    """ (frames shown, duration in seconds, decode timestamps increasing) of an MP4 """
+    import av
+    with av.open(video_path) as container:
+        stream = container.streams.video[0]
+        last_pts = 0
+        dts_list = []
+        for packet in container.demux(stream):
+            if packet.dts is None:
+                continue
+            dts_list.append(packet.dts)
+            last_pts = max(last_pts, packet.pts)
+        # the held frames are sparse, the frames shown come from the timestamps. The packet
+        # durations can not tell the end, the one of a reordered frame may span a hold gap
+        n_frames = round(last_pts * stream.time_base * frame_rate) + 1
+        # what players show, it comes from the last decode timestamp
+        duration = float(stream.duration * stream.time_base)
+        dts_ok = all(dts_1 < dts_2 for dts_1, dts_2 in zip(dts_list, dts_list[1:]))
+    return n_frames, round(duration, 3), dts_ok
+
+
+def iter_shown_frames(video_path, frame_rate):
+    """ The decoded frame on screen at every frame index, a held frame is repeated until the next one """
+    import av
+    with av.open(video_path) as container:
+        stream = container.streams.video[0]
+        frame_index = 0
+        shown = None
+        for frame in container.decode(stream):
+            start = round(frame.pts * stream.time_base * frame_rate)
+            while shown is not None and frame_index < start:
+                yield shown
+                frame_index += 1
+            shown = frame.to_ndarray(format="gray")
+        if shown is not None:
+            yield shown
+
+
+def get_frame_diff(video_path, serial_path, frame_rate):
+    """ Largest mean pixel difference of a frame against the serial render """
+    max_diff = 0.0
+    for frame, serial_frame in zip(iter_shown_frames(video_path, frame_rate), iter_shown_frames(serial_path, frame_rate)):
+        max_diff = max(max_diff, float(np.abs(frame.astype(np.int16) - serial_frame).mean()))
+    return round(max_diff, 2)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--size", default="480p", help="one of " + ",".join(sizes))
+    parser.add_argument("--segments", default="2,3,4")
+    parser.add_argument("--holds", default="2,5", help="end hold durations in seconds, comma separated")
+    parser.add_argument("--split-len", type=int, default=20)
+    # both renders are lossy, the segments start new GOPs
+    parser.add_argument("--max-diff", type=float, default=2.0, help="largest mean pixel difference of a frame")
+    args = parser.parse_args()
+
+    wd, ht = sizes[args.size]
+    frame_rate = 25
+    failures = []
+    with tempfile.TemporaryDirectory() as work_dir:
+        image_path = os.path.join(work_dir, "image.png")
+        cv2.imwrite(image_path, make_synthetic_image(wd, ht))
+        for hold in [int(x) for x in args.holds.split(",")]:
+            timings = {}
+            paths = {}
+            for segments in [1] + [int(x) for x in args.segments.split(",")]:
+                result = sketchApi.render_sketch(
+                    image_path, args.split_len, frame_rate, 8, 14, hold, save_path=work_dir,
+                    output_path=os.path.join(work_dir, f"hold{hold}_seg{segments}.mp4"),
+                    segments=segments, use_cache=False, collect_stats=False,
+                )
+                if not result["status"]:
+                    failures.append(f"hold {hold} s, {segments} segments: {result['message']}")
+                    continue
+                timings[segments] = get_video_timing(result["message"], frame_rate)
+                paths[segments] = result["message"]
+            serial = timings.get(1)
+            for segments, timing in timings.items():
+                try:
+                    frame_diff = get_frame_diff(paths[segments], paths[1], frame_rate) if serial is not None else None
+                except Exception as e:
+                    # e.g. the parameter sets of a segment do not match the joined stream
+                    print(f"hold {hold} s, {segments} segments: decode error: {e}")
+                    frame_diff = None
+                ok = (
+                    serial is not None and timing[:2] == serial[:2] and timing[2]
+                    and frame_diff is not None and frame_diff <= args.max_diff
+                )
+                print(
+                    f"hold {hold} s, {segments} segments: {timing[0]} frames, {timing[1]} s, "
+                    f"dts increasing {timing[2]}, frame diff {frame_diff}{'' if ok else ' MISMATCH'}"
+                )
+                if not ok:
+                    failures.append(
+                        f"hold {hold} s, {segments} segments: {timing}, frame diff {frame_diff} vs serial {serial}"
+                    )
+    if failures:
+        sys.exit("\n".join(failures))
+    print("Segmented renders match the serial render")
+
+
+if __name__ == "__main__":
+    main()
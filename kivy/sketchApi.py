@@ -1,14 +1,22 @@
 import os, stat, shutil
 import sys
 import subprocess
+import threading
+import queue
+import multiprocessing
+import importlib.util
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, FIRST_COMPLETED, wait
 from pathlib import Path
 import time
-import math
 import json
 import datetime
+import hashlib
+import uuid
+import contextlib
+import tracemalloc
+from fractions import Fraction
 import cv2
 import numpy as np
-from kivy.clock import Clock
 
 # global variables
 if getattr(sys, 'frozen', False):
@@ -22,23 +30,98 @@ hand_path = os.path.join(images_path, 'drawing-hand.png')
 hand_mask_path = os.path.join(images_path, 'hand-mask.png')
 save_path = os.path.join(base_path, "save_videos")
 platform = "linux"
-progress_updater = None
 
 ## All functions
-def euc_dist(arr1, point):
-    square_sub = (arr1 - point) ** 2
-    return np.sqrt(np.sum(square_sub, axis=1))
+class NearestTileTraversal:
+    """
+    Greedy nearest-neighbour walk over the inked tiles of a grid.
+
+    The remaining tiles are kept in an occupancy grid, so finding the next
+    tile only scans a window around the current one (doubled until it is
+    big enough) instead of every remaining tile. The visiting order is the
+    same as the old `euc_dist` + `np.argmin` loop, including its tie-breaking:
+    the old loop removed a tile by moving the last entry into its slot and
+    `argmin` returned the lowest slot, so `slot_of` replays those moves.
+    Once `cancel_event` is set the walk raises RenderCancelled.
+    """
+
+    # tiles walked between two looks at cancel_event, a dense 4K grid has ~80k tiles
+    cancel_check_every = 1024
+
+    def __init__(self, tile_indices, grid_shape, cancel_event=None):
+        tile_indices = np.asarray(tile_indices, dtype=np.int64).reshape(-1, 2)
+        self.grid_ht, self.grid_wd = int(grid_shape[0]), int(grid_shape[1])
+        self.alive = np.zeros((self.grid_ht, self.grid_wd), dtype=bool)
+        self.slot_of = np.full((self.grid_ht, self.grid_wd), -1, dtype=np.int64)
+        self.alive[tile_indices[:, 0], tile_indices[:, 1]] = True
+        self.slot_of[tile_indices[:, 0], tile_indices[:, 1]] = np.arange(len(tile_indices))
+        self.slots = [(int(r), int(c)) for r, c in tile_indices]
+        self.cancel_event = cancel_event
+
+    def __len__(self):
+        return len(self.slots)
+
+    def remove(self, tile):
+        """ Drop a tile, moving the last slot into its place like the old loop did """
+        slot = self.slot_of[tile]
+        last = self.slots.pop()
+        if last != tile:
+            self.slots[slot] = last
+            self.slot_of[last] = slot
+        self.alive[tile] = False
+        self.slot_of[tile] = -1
+
+    def nearest(self, tile):
+        """ Closest remaining tile to `tile`, lowest slot first on equal distance """
+        row, col = tile
+        radius = 1
+        while True:
+            r0, r1 = max(row - radius, 0), min(row + radius + 1, self.grid_ht)
+            c0, c1 = max(col - radius, 0), min(col + radius + 1, self.grid_wd)
+            whole_grid = r0 == 0 and c0 == 0 and r1 == self.grid_ht and c1 == self.grid_wd
+            ys, xs = np.nonzero(self.alive[r0:r1, c0:c1])
+            if len(ys):
+                ys += r0
+                xs += c0
+                dist_sq = (ys - row) ** 2 + (xs - col) ** 2
+                best = dist_sq.min()
+                # anything outside the window is at least radius + 1 away
+                if best < (radius + 1) ** 2 or whole_grid:
+                    ties = np.nonzero(dist_sq == best)[0]
+                    if len(ties) > 1:
+                        ties = ties[np.argmin(self.slot_of[ys[ties], xs[ties]])]
+                    else:
+                        ties = ties[0]
+                    return int(ys[ties]), int(xs[ties])
+            elif whole_grid:
+                return None
+            radius *= 2
+
+    def __iter__(self):
+        """
+        Yields the tiles in drawing order. Like the old loop, the walk stops
+        when one tile is left, that one is covered by the final full image.
+        """
+        if not self.slots:
+            return
+        current = self.slots[0]
+        n_walked = 0
+        while len(self.slots) > 1:
+            if n_walked % self.cancel_check_every == 0 and self.cancel_event is not None and self.cancel_event.is_set():
+                raise RenderCancelled("Render cancelled")
+            n_walked += 1
+            yield current
+            self.remove(current)
+            current = self.nearest(current)
 
 def preprocess_image(img, variables):
     #img = cv2.imread(img_path)
     img_ht, img_wd = img.shape[0], img.shape[1]
-    img = cv2.resize(img, (variables.resize_wd, variables.resize_ht))
+    if (img_wd, img_ht) != (variables.resize_wd, variables.resize_ht):
+        # read_video_image gives the image at the video size already
+        img = cv2.resize(img, (variables.resize_wd, variables.resize_ht))
     img_gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
 
-    # color histogram equilization
-    clahe = cv2.createCLAHE(clipLimit=2.0, tileGridSize=(3, 3))
-    cl1 = clahe.apply(img_gray)
-
     # gaussian adaptive thresholding
     img_thresh = cv2.adaptiveThreshold(
         img_gray, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C, cv2.THRESH_BINARY, 15, 10
@@ -47,28 +130,108 @@ def preprocess_image(img, variables):
     # adding all the computed required items in variables object
     variables.img_ht = img_ht
     variables.img_wd = img_wd
-    variables.img_gray = img_gray
+    # only the threshold image is used later, no need to keep the gray one in memory bounded mode
+    variables.img_gray = None if variables.memory_bounded else img_gray
     variables.img_thresh = img_thresh
     variables.img = img
     return variables
 
 
-def preprocess_hand_image(hand_path, hand_mask_path, variables):
-    hand = cv2.imread(hand_path)
-    hand_mask = cv2.imread(hand_mask_path, cv2.IMREAD_GRAYSCALE)
+# process wide cache of the prepared hand images, see get_hand_assets
+hand_cache = {}
+hand_cache_lock = threading.Lock()
+
+
+def load_hand_source(hand_path, hand_mask_path=None):
+    """
+    Reads & crops the hand and its mask. Without a mask path the hand image
+    must be a PNG with an alpha channel, which is used as the mask.
+    """
+    if hand_mask_path is None:
+        hand_rgba = cv2.imread(hand_path, cv2.IMREAD_UNCHANGED)
+        if hand_rgba is None or hand_rgba.ndim != 3 or hand_rgba.shape[2] != 4:
+            raise ValueError(f"The hand image needs a mask or an alpha channel: {hand_path}")
+        if hand_rgba.dtype == np.uint16:
+            hand_rgba = (hand_rgba // 257).astype(np.uint8)
+        hand = hand_rgba[:, :, :3]
+        hand_mask = hand_rgba[:, :, 3]
+        # soft alpha edges are kept, the crop is to every visible pixel
+        top_left, bottom_right = get_extreme_coordinates(np.where(hand_mask > 0, 255, 0))
+    else:
+        hand = cv2.imread(hand_path)
+        hand_mask = cv2.imread(hand_mask_path, cv2.IMREAD_GRAYSCALE)
+        if hand is None or hand_mask is None:
+            raise ValueError(f"Can not read the hand images: {hand_path}, {hand_mask_path}")
+        top_left, bottom_right = get_extreme_coordinates(hand_mask)
 
-    top_left, bottom_right = get_extreme_coordinates(hand_mask)
     hand = hand[top_left[1] : bottom_right[1], top_left[0] : bottom_right[0]]
     hand_mask = hand_mask[top_left[1] : bottom_right[1], top_left[0] : bottom_right[0]]
-    hand_mask_inv = 255 - hand_mask
+    return np.ascontiguousarray(hand), np.ascontiguousarray(hand_mask)
 
-    # standardizing the hand masks
-    hand_mask = hand_mask / 255
-    hand_mask_inv = hand_mask_inv / 255
 
-    # making the hand background black
-    hand_bg_ind = np.where(hand_mask == 0)
-    hand[hand_bg_ind] = [0, 0, 0]
+def scale_hand(hand, hand_mask, scale):
+    """
+    Premultiplied hand, its mask & the 3 channel inverse mask in uint8 for
+    the blend kernel, resized by `scale`. Premultiplying also makes the hand
+    background black where the mask is 0.
+    """
+    hand = cv2.multiply(hand, cv2.cvtColor(hand_mask, cv2.COLOR_GRAY2BGR), scale=1 / 255)
+    if scale != 1:
+        # resizing the premultiplied colours & the mask together gives clean edges
+        hand_size = (
+            max(1, int(round(hand.shape[1] * scale))),
+            max(1, int(round(hand.shape[0] * scale))),
+        )
+        hand = cv2.resize(hand, hand_size, interpolation=cv2.INTER_AREA)
+        hand_mask = cv2.resize(hand_mask, hand_size, interpolation=cv2.INTER_AREA)
+    hand_mask_inv = cv2.cvtColor(255 - hand_mask, cv2.COLOR_GRAY2BGR)
+    return hand, hand_mask, hand_mask_inv
+
+
+def get_hand_assets(hand_path, hand_mask_path=None, scale=1):
+    """
+    (hand, hand_mask, hand_mask_inv) from the process wide cache. The files
+    are read once per path & modification time, every scale is prepared
+    once. The arrays are shared, so they are read only.
+    """
+    key = (
+        os.path.abspath(hand_path),
+        os.path.getmtime(hand_path),
+        hand_mask_path and os.path.abspath(hand_mask_path),
+        hand_mask_path and os.path.getmtime(hand_mask_path),
+    )
+    scale_key = round(float(scale), 3)
+    with hand_cache_lock:
+        entry = hand_cache.get(key)
+        if entry is None:
+            # an edited file gets a new key, forget its older versions
+            for old_key in [old_key for old_key in hand_cache if old_key[0::2] == key[0::2]]:
+                del hand_cache[old_key]
+            entry = {"source": load_hand_source(hand_path, hand_mask_path), "variants": {}}
+            hand_cache[key] = entry
+        variant = entry["variants"].get(scale_key)
+        if variant is None:
+            variant = scale_hand(*entry["source"], scale_key)
+            for array in variant:
+                array.flags.writeable = False
+            entry["variants"][scale_key] = variant
+    return variant
+
+
+def get_hand_scale(variables):
+    """ The bundled hand is drawn for 1080p, by default it keeps that size relative to the video """
+    if variables.hand_scale is not None:
+        return variables.hand_scale
+    if not variables.resize_wd or not variables.resize_ht:
+        return 1
+    return min(variables.resize_wd, variables.resize_ht) / 1080
+
+
+def preprocess_hand_image(hand_path, hand_mask_path, variables):
+    """ hand_mask_path can be None for a hand PNG with an alpha channel """
+    hand, hand_mask, hand_mask_inv = get_hand_assets(
+        hand_path, hand_mask_path, get_hand_scale(variables)
+    )
 
     # getting the img and hand dim
     hand_ht, hand_wd = hand.shape[0], hand.shape[1]
@@ -105,239 +268,339 @@ def draw_hand_on_img(
     img_ht,
     img_wd,
 ):
-    remaining_ht = img_ht - drawing_coord_y
-    remaining_wd = img_wd - drawing_coord_x
-    if remaining_ht > hand_ht:
-        crop_hand_ht = hand_ht
-    else:
-        crop_hand_ht = remaining_ht
-
-    if remaining_wd > hand_wd:
-        crop_hand_wd = hand_wd
-    else:
-        crop_hand_wd = remaining_wd
-
-    hand_cropped = hand[:crop_hand_ht, :crop_hand_wd]
-    hand_mask_inv_cropped = hand_mask_inv[:crop_hand_ht, :crop_hand_wd]
-
-    drawing[
-        drawing_coord_y : drawing_coord_y + crop_hand_ht,
-        drawing_coord_x : drawing_coord_x + crop_hand_wd,
-    ][:, :, 0] = (
-        drawing[
-            drawing_coord_y : drawing_coord_y + crop_hand_ht,
-            drawing_coord_x : drawing_coord_x + crop_hand_wd,
-        ][:, :, 0]
-        * hand_mask_inv_cropped
-    )
-    drawing[
-        drawing_coord_y : drawing_coord_y + crop_hand_ht,
-        drawing_coord_x : drawing_coord_x + crop_hand_wd,
-    ][:, :, 1] = (
-        drawing[
-            drawing_coord_y : drawing_coord_y + crop_hand_ht,
-            drawing_coord_x : drawing_coord_x + crop_hand_wd,
-        ][:, :, 1]
-        * hand_mask_inv_cropped
-    )
-    drawing[
-        drawing_coord_y : drawing_coord_y + crop_hand_ht,
-        drawing_coord_x : drawing_coord_x + crop_hand_wd,
-    ][:, :, 2] = (
-        drawing[
-            drawing_coord_y : drawing_coord_y + crop_hand_ht,
-            drawing_coord_x : drawing_coord_x + crop_hand_wd,
-        ][:, :, 2]
-        * hand_mask_inv_cropped
-    )
+    """
+    Blends the hand into `drawing` in place: drawing * (1 - mask) + hand.
+    `hand` is premultiplied and `hand_mask_inv` is a 3 channel uint8 mask (see
+    preprocess_hand_image), so all channels are done by two OpenCV calls on
+    uint8 data.
+    """
+    crop_hand_ht = min(hand_ht, img_ht - drawing_coord_y)
+    crop_hand_wd = min(hand_wd, img_wd - drawing_coord_x)
 
-    drawing[
+    drawing_roi = drawing[
         drawing_coord_y : drawing_coord_y + crop_hand_ht,
         drawing_coord_x : drawing_coord_x + crop_hand_wd,
-    ] = (
-        drawing[
-            drawing_coord_y : drawing_coord_y + crop_hand_ht,
-            drawing_coord_x : drawing_coord_x + crop_hand_wd,
-        ]
-        + hand_cropped
+    ]
+    cv2.multiply(
+        drawing_roi, hand_mask_inv[:crop_hand_ht, :crop_hand_wd], dst=drawing_roi, scale=1 / 255
     )
+    cv2.add(drawing_roi, hand[:crop_hand_ht, :crop_hand_wd], dst=drawing_roi)
     return drawing
 
 
-def draw_masked_object(
-    variables, object_mask=None, skip_rate=5, black_pixel_threshold=10
-):
+class DrawPass:
     """
-    skip_rate is not provided via variables because this function does not
-    know it is drawing object or background or an entire image
+    One drawing pass of a plan: the whole image, one masked object or the
+    background. `tiles` holds the grid (row, col) of every tile in drawing
+    order and `frames` the tile counts after which a frame is written.
+    `mask` may cover only a tile aligned box of the frame, which starts at
+    the pixel (row, col) `mask_origin`.
     """
-    print("Skip Rate: ", skip_rate)
-    # if there is object mask, then the img_thresh will only correspond to the mask provided
-    img_thresh_copy = variables.img_thresh.copy()
-    if object_mask is not None:
-        # get the object and its background indices
-        object_mask_black_ind = np.where(object_mask == 0)
-        object_ind = np.where(object_mask == 255)
 
-        # make area other than object white
-        img_thresh_copy[object_mask_black_ind] = 255
+    def __init__(self, split_len, tiles, n_inked, skip_rate, kind="object", mask=None, mask_origin=(0, 0)):
+        self.split_len = int(split_len)
+        self.tiles = np.asarray(tiles, dtype=np.int32).reshape(-1, 2)
+        self.n_inked = int(n_inked)  # inked tiles incl. the last one which is never drawn
+        self.skip_rate = int(skip_rate)
+        self.kind = kind
+        self.mask = mask
+        self.mask_origin = (int(mask_origin[0]), int(mask_origin[1]))
+        self.frames = np.arange(self.skip_rate, len(self.tiles) + 1, self.skip_rate, dtype=np.int32)
 
-    selected_ind = 0
-    n_cuts_vertical = int(math.ceil(variables.resize_ht / variables.split_len))
-    n_cuts_horizontal = int(math.ceil(variables.resize_wd / variables.split_len))
+    def frame_bounds(self, skip_rate):
+        """ Frame boundaries for another skip rate, the tile order stays the same """
+        if skip_rate == self.skip_rate:
+            return self.frames
+        return np.arange(skip_rate, len(self.tiles) + 1, skip_rate, dtype=np.int32)
 
-    # cut the image into grids
-    grid_of_cuts = np.array(np.split(img_thresh_copy, n_cuts_horizontal, axis=-1))
-    grid_of_cuts = np.array(np.split(grid_of_cuts, n_cuts_vertical, axis=-2))
-    print(grid_of_cuts.shape)
-
-    # find grids where there is atleast one black pixel
-    # as only these grids will be drawn
-    cut_having_black = (grid_of_cuts < black_pixel_threshold) * 1
-    cut_having_black = np.sum(np.sum(cut_having_black, axis=-1), axis=-1)
-    cut_black_indices = np.array(np.where(cut_having_black > 0)).T
-    print(f"No of indices: {len(cut_black_indices)}")
-    step_div = len(cut_black_indices) / 40
-    progress_step_no = 100 / step_div
-    print(f"Step interval: {progress_step_no}")
-    sk_progress = 0
 
-    counter = 0
-    while len(cut_black_indices) > 1:
-        selected_ind_val = cut_black_indices[selected_ind].copy()
-        range_v_start = selected_ind_val[0] * variables.split_len
-        range_v_end = range_v_start + variables.split_len
-        range_h_start = selected_ind_val[1] * variables.split_len
-        range_h_end = range_h_start + variables.split_len
-
-        temp_drawing = np.zeros((variables.split_len, variables.split_len, 3))
-        temp_drawing[:, :, 0] = grid_of_cuts[selected_ind_val[0]][selected_ind_val[1]]
-        temp_drawing[:, :, 1] = grid_of_cuts[selected_ind_val[0]][selected_ind_val[1]]
-        temp_drawing[:, :, 2] = grid_of_cuts[selected_ind_val[0]][selected_ind_val[1]]
-
-        variables.drawn_frame[range_v_start:range_v_end, range_h_start:range_h_end] = (
-            temp_drawing
+class DrawPlan:
+    """
+    Everything the renderer needs to know about the drawing order of an image,
+    worked out once from the thresholded image, the masks and `split_len`.
+    It does not depend on frame rate, hand or end duration, so it can be saved
+    and reused for renders which only change those.
+    """
+    version = 2
+    pass_kinds = ["object", "background"]
+
+    def __init__(self, resize_wd, resize_ht, thresh_digest, split_len, mask_digest=""):
+        self.resize_wd = int(resize_wd)
+        self.resize_ht = int(resize_ht)
+        self.thresh_digest = thresh_digest
+        self.split_len = int(split_len)
+        self.mask_digest = mask_digest  # see get_mask_digest, "" without a mask
+        self.passes = []
+
+    def matches(self, variables, mask_path=None):
+        return (
+            self.resize_wd == variables.resize_wd
+            and self.resize_ht == variables.resize_ht
+            and self.split_len == variables.split_len
+            and self.mask_digest == get_mask_digest(mask_path)
+            and self.thresh_digest == get_thresh_digest(variables.img_thresh)
         )
 
-        if variables.draw_hand:
-            hand_coord_x = range_h_start + int(variables.split_len / 2)
-            hand_coord_y = range_v_start + int(variables.split_len / 2)
-            drawn_frame_with_hand = draw_hand_on_img(
-                variables.drawn_frame.copy(),
-                variables.hand.copy(),
-                hand_coord_x,
-                hand_coord_y,
-                variables.hand_mask_inv.copy(),
-                variables.hand_ht,
-                variables.hand_wd,
-                variables.resize_ht,
-                variables.resize_wd,
+    def save(self, plan_path):
+        """ Saves as a compressed numpy archive (.npz), at plan_path whatever its suffix """
+        arrays = {
+            "meta": np.array(
+                [self.version, self.resize_wd, self.resize_ht, len(self.passes), self.split_len], np.int32
+            ),
+            "digest": np.frombuffer(bytes.fromhex(self.thresh_digest), np.uint8),
+            "mask_digest": np.frombuffer(bytes.fromhex(self.mask_digest), np.uint8),
+        }
+        for i, draw_pass in enumerate(self.passes):
+            arrays[f"pass{i}_info"] = np.array(
+                [draw_pass.split_len, draw_pass.n_inked, draw_pass.skip_rate, self.pass_kinds.index(draw_pass.kind)],
+                np.int32,
             )
-        else:
-            drawn_frame_with_hand = variables.drawn_frame.copy()
+            arrays[f"pass{i}_tiles"] = draw_pass.tiles
+            arrays[f"pass{i}_frames"] = draw_pass.frames
+            if draw_pass.mask is not None:
+                arrays[f"pass{i}_mask"] = draw_pass.mask
+                arrays[f"pass{i}_origin"] = np.array(draw_pass.mask_origin, np.int32)
+        # through a file object: with a path numpy adds ".npz" to any other suffix
+        with open(plan_path, "wb") as file:
+            np.savez_compressed(file, **arrays)
+
+    @classmethod
+    def load(cls, plan_path):
+        with np.load(plan_path) as data:
+            version = int(data["meta"][0])
+            if version != cls.version:
+                # version 1 plans do not record the split length & mask, they are planned again
+                raise ValueError(f"Unsupported draw plan version: {version}, delete the plan file")
+            _, resize_wd, resize_ht, n_passes, split_len = data["meta"].tolist()
+            plan = cls(
+                resize_wd, resize_ht, data["digest"].tobytes().hex(), split_len, data["mask_digest"].tobytes().hex()
+            )
+            for i in range(n_passes):
+                split_len, n_inked, skip_rate, kind = data[f"pass{i}_info"].tolist()
+                mask = data[f"pass{i}_mask"] if f"pass{i}_mask" in data.files else None
+                # plans saved before the mask boxes have full frame masks
+                origin = data[f"pass{i}_origin"].tolist() if f"pass{i}_origin" in data.files else (0, 0)
+                draw_pass = DrawPass(
+                    split_len, data[f"pass{i}_tiles"], n_inked, skip_rate, cls.pass_kinds[kind], mask, origin
+                )
+                draw_pass.frames = data[f"pass{i}_frames"]
+                plan.passes.append(draw_pass)
+        return plan
 
-        # delete the selected ind from the d_array
-        cut_black_indices[selected_ind] = cut_black_indices[-1]
-        cut_black_indices = cut_black_indices[:-1]
 
-        del selected_ind
+def get_thresh_digest(img_thresh):
+    return hashlib.sha1(np.ascontiguousarray(img_thresh).tobytes()).hexdigest()
 
-        # select the next new index
-        euc_arr = euc_dist(cut_black_indices, selected_ind_val)
-        selected_ind = np.argmin(euc_arr)
 
-        counter += 1
-        if counter % skip_rate == 0:
-            variables.video_object.write(drawn_frame_with_hand)
+def get_mask_digest(mask_path=None):
+    """ sha1 of the LabelMe JSON file, "" without a mask """
+    if not mask_path:
+        return ""
+    with open(mask_path, "rb") as file:
+        return hashlib.sha1(file.read()).hexdigest()
+
+
+def get_thresh_for_mask(img_thresh, object_mask=None):
+    # if there is object mask, then the img_thresh will only correspond to the mask provided
+    if object_mask is None:
+        return img_thresh
+    img_thresh_copy = img_thresh.copy()
+    # make area other than object white
+    img_thresh_copy[object_mask == 0] = 255
+    return img_thresh_copy
+
+
+def get_frame_tiles(frame, split_len):
+    """ View of a (ht, wd, 3) frame as (rows, cols, split_len, split_len, 3) tiles, no copy """
+    frame_ht, frame_wd = frame.shape[:2]
+    return frame.reshape(
+        frame_ht // split_len, split_len, frame_wd // split_len, split_len, -1
+    ).swapaxes(1, 2)
+
+
+def get_grid_of_cuts(img_thresh, split_len):
+    """ View of a (ht, wd) image as (rows, cols, split_len, split_len) tiles, no copy """
+    n_cuts_vertical = img_thresh.shape[0] // split_len
+    n_cuts_horizontal = img_thresh.shape[1] // split_len
+
+    # cut the image into grids
+    return img_thresh.reshape(n_cuts_vertical, split_len, n_cuts_horizontal, split_len).swapaxes(1, 2)
 
-        if counter % 40 == 0:
-            #print("len of black indices: ", len(cut_black_indices))
-            sk_progress += progress_step_no
-            if progress_updater:
-                Clock.schedule_once(lambda dt: progress_updater(sk_progress))
 
+def get_mask_region(img, mask, mask_origin):
+    """ The part of a frame sized image under a mask box """
+    row, col = mask_origin
+    return img[row : row + mask.shape[0], col : col + mask.shape[1]]
+
+
+def plan_inked_tiles(
+    variables, cut_having_black, split_len, skip_rate, kind, object_mask=None, mask_origin=(0, 0)
+):
+    """ Drawing order of the inked tiles, `cut_having_black` may be the tile grid of a mask box only """
+    cut_black_indices = np.argwhere(cut_having_black)
+    cut_black_indices += (mask_origin[0] // split_len, mask_origin[1] // split_len)
+    print(f"No of indices: {len(cut_black_indices)}")
+
+    grid_shape = (variables.resize_ht // split_len, variables.resize_wd // split_len)
+    traversal = NearestTileTraversal(cut_black_indices, grid_shape, variables.cancel_event)
+    tiles = np.array(list(traversal), dtype=np.int32).reshape(-1, 2)
+    return DrawPass(split_len, tiles, len(cut_black_indices), skip_rate, kind, object_mask, mask_origin)
+
+
+def plan_masked_object(
+    variables, object_mask=None, split_len=None, skip_rate=5, black_pixel_threshold=10, kind="object",
+    mask_origin=(0, 0)
+):
+    """ Works out the tile drawing order for the whole image or one object mask (box) """
+    if split_len is None:
+        split_len = variables.split_len
+    img_thresh = variables.img_thresh
     if object_mask is not None:
-        variables.drawn_frame[:, :, :][object_ind] = variables.img[object_ind]
-    else:
-        variables.drawn_frame[:, :, :] = variables.img
+        img_thresh = get_mask_region(img_thresh, object_mask, mask_origin)
+    grid_of_cuts = get_grid_of_cuts(get_thresh_for_mask(img_thresh, object_mask), split_len)
+    print(grid_of_cuts.shape)
 
+    # find grids where there is atleast one black pixel
+    # as only these grids will be drawn
+    cut_having_black = grid_of_cuts.min(axis=(2, 3)) < black_pixel_threshold
+    return plan_inked_tiles(variables, cut_having_black, split_len, skip_rate, kind, object_mask, mask_origin)
 
-def draw_whiteboard_animations(
-    img, mask_path, hand_path, hand_mask_path, save_video_path, variables, end_color=True
+
+def plan_background(
+    variables, background_mask, touched_tiles, split_len=20, skip_rate=5, black_pixel_threshold=10
 ):
-    if mask_path is not None:
-        object_mask_exists = True
-    else:
-        object_mask_exists = False
+    """
+    Drawing order of the background. Tiles no object box touched
+    (`touched_tiles` is False) are inked exactly like in the plain image,
+    only the touched ones are checked against the background mask.
+    """
+    grid_of_cuts = get_grid_of_cuts(variables.img_thresh, split_len)
+    cut_having_black = grid_of_cuts.min(axis=(2, 3)) < black_pixel_threshold
+    rows, cols = np.nonzero(touched_tiles & cut_having_black)
+    if len(rows):
+        mask_cuts = get_grid_of_cuts(background_mask, split_len)[rows, cols]
+        cut_having_black[rows, cols] = (
+            np.where(mask_cuts == 0, np.uint8(255), grid_of_cuts[rows, cols]).min(axis=(1, 2))
+            < black_pixel_threshold
+        )
+    return plan_inked_tiles(variables, cut_having_black, split_len, skip_rate, "background", background_mask)
 
-    # reading the image and converting it to grayscale,
-    # computing clahe and later therholding
-    variables = preprocess_image(img=img, variables=variables)
 
-    # reading hand image and preprocess
-    variables = preprocess_hand_image(
-        hand_path=hand_path, hand_mask_path=hand_mask_path, variables=variables
-    )
+def find_labelme_mask(image_path):
+    """ LabelMe saves the shapes of `photo.jpg` next to it as `photo.json` """
+    mask_path = f"{os.path.splitext(image_path)[0]}.json"
+    if not os.path.isfile(mask_path):
+        return None
+    try:
+        with open(mask_path) as file:
+            if "shapes" in json.load(file):
+                return mask_path
+    except (OSError, ValueError):
+        pass
+    return None
 
-    # calculate how much time it takes to make video for 1 image
-    start_time = time.time()
 
-    # defining the video object
-    print(f"Selected platform in sketch api: {platform}")
-    if platform == "android":
-        fourcc = cv2.VideoWriter_fourcc(*"MJPG") #mpg2 or h264 or MJPG
-    else:
-        fourcc = cv2.VideoWriter_fourcc(*"mp4v") #mp4v
-    variables.video_object = cv2.VideoWriter(
-        save_video_path,
-        fourcc,
-        variables.frame_rate,
-        (variables.resize_wd, variables.resize_ht),
-    )
+def get_mask_transform(variables, object_masks):
+    """
+    (scale_x, scale_y, offset_x, offset_y) from the LabelMe image to the
+    video frame. render_sketch sets `variables.image_box` when it pads the
+    image, otherwise the image is stretched to the video size.
+    """
+    source_wd, source_ht = variables.source_size or (variables.img_wd, variables.img_ht)
+    left, top, box_wd, box_ht = variables.image_box or (0, 0, variables.resize_wd, variables.resize_ht)
+    label_wd = object_masks.get("imageWidth") or source_wd
+    label_ht = object_masks.get("imageHeight") or source_ht
+    return (box_wd / label_wd, box_ht / label_ht, left, top)
 
-    # creating an emtpy frame and select 0th index as the starting point to draw
-    variables.drawn_frame = np.zeros(variables.img.shape, np.uint8) + np.array(
-        [255, 255, 255], np.uint8
-    )
 
-    if object_mask_exists:
+def rasterize_mask_shape(shape, transform, frame_wd, frame_ht, split_len):
+    """
+    Fills one LabelMe shape (polygon, rectangle or circle) at the video
+    resolution, only in its tile aligned bounding box. Returns the box mask
+    and its (row, col) origin, or None when the shape is not in the frame.
+    """
+    scale_x, scale_y, offset_x, offset_y = transform
+    points = np.array(shape["points"], dtype=np.float64).reshape(-1, 2)
+    points = points * (scale_x, scale_y) + (offset_x, offset_y)
+    shape_type = shape.get("shape_type") or "polygon"
+    if shape_type == "circle" and len(points) == 2:
+        radius = np.hypot(*(points[1] - points[0]))
+        box_points = np.array([points[0] - radius, points[0] + radius])
+    elif shape_type in ("polygon", "rectangle") and len(points) >= 2:
+        box_points = points
+    else:
+        print(f"Skipping the {shape_type} mask shape")
+        return None
+
+    col0 = max(0, int(np.floor(box_points[:, 0].min())) // split_len * split_len)
+    row0 = max(0, int(np.floor(box_points[:, 1].min())) // split_len * split_len)
+    col1 = min(frame_wd, -(-(int(np.ceil(box_points[:, 0].max())) + 1) // split_len) * split_len)
+    row1 = min(frame_ht, -(-(int(np.ceil(box_points[:, 1].max())) + 1) // split_len) * split_len)
+    if col1 <= col0 or row1 <= row0:
+        return None
+
+    # 4 fractional bits, the corners are not rounded to whole pixels
+    shift = 4
+    local_points = np.round((points - (col0, row0)) * (1 << shift)).astype(np.int32)
+    object_mask = np.zeros((row1 - row0, col1 - col0), dtype=np.uint8)
+    if shape_type == "circle":
+        cv2.circle(object_mask, tuple(local_points[0].tolist()), int(round(radius * (1 << shift))), 255, -1, shift=shift)
+    elif shape_type == "rectangle":
+        cv2.rectangle(object_mask, tuple(local_points[0].tolist()), tuple(local_points[1].tolist()), 255, -1, shift=shift)
+    else:
+        cv2.fillPoly(object_mask, [local_points], 255, shift=shift)
+    if not object_mask.any():
+        return None
+    return object_mask, (row0, col0)
+
 
+def plan_whiteboard_animation(variables, mask_path=None):
+    """
+    Planning stage of `draw_whiteboard_animations`, needs `preprocess_image`
+    to be done on the variables
+    """
+    plan = DrawPlan(
+        variables.resize_wd, variables.resize_ht, get_thresh_digest(variables.img_thresh), variables.split_len,
+        get_mask_digest(mask_path),
+    )
+    if mask_path is not None:
         # reading the object masks
         with open(mask_path) as file:
             object_masks = json.load(file)
+        transform = get_mask_transform(variables, object_masks)
 
-        background_mask = (
-            np.zeros((variables.resize_ht, variables.resize_wd), dtype=np.uint8) + 255
+        background_split_len = 20
+        background_mask = np.full((variables.resize_ht, variables.resize_wd), 255, dtype=np.uint8)
+        # background tiles an object box overlaps, only these need a pixel check later
+        touched_tiles = np.zeros(
+            (variables.resize_ht // background_split_len, variables.resize_wd // background_split_len), dtype=bool
         )
 
         for object in object_masks["shapes"]:
-            # Create an empty mask array
-            object_mask = np.zeros((variables.img_ht, variables.img_wd), dtype=np.uint8)
-
-            # Get the object points as a list of tuples
-            object_points = np.array(object["points"], dtype=np.int32)
-            object_points = np.expand_dims(object_points, axis=0)
-
-            # Fill the polygon with white color (255) on the mask array using cv2
-            cv2.fillPoly(object_mask, object_points, 255)
-
-            # resizing the object_mask
-            object_mask = cv2.resize(
-                object_mask, (variables.resize_wd, variables.resize_ht)
+            check_cancelled(variables)
+            # every object only costs as much as its bounding box
+            rasterized = rasterize_mask_shape(
+                object, transform, variables.resize_wd, variables.resize_ht, variables.split_len
             )
-
-            # get the object and its background indices
-            object_ind = np.where(object_mask == 255)
+            if rasterized is None:
+                continue
+            object_mask, mask_origin = rasterized
 
             # remove the object from backgrond mask
-            background_mask[object_ind] = 0
-
-            # create animation for the selected object
-            draw_masked_object(
-                variables=variables,
+            get_mask_region(background_mask, object_mask, mask_origin)[object_mask == 255] = 0
+            row0, col0 = mask_origin
+            touched_tiles[
+                row0 // background_split_len : -(-(row0 + object_mask.shape[0]) // background_split_len),
+                col0 // background_split_len : -(-(col0 + object_mask.shape[1]) // background_split_len),
+            ] = True
+
+            plan.passes.append(plan_masked_object(
+                variables,
                 object_mask=object_mask,
                 skip_rate=variables.object_skip_rate,
-            )
+                kind="object",
+                mask_origin=mask_origin,
+            ))
 
         # now draw the last remaing background part
         """
@@ -345,45 +608,354 @@ def draw_whiteboard_animations(
         # area covered in one loop iteration will be much larger
         """
         # Optional:
-        print("Drawing the blakground region..")
-        variables.split_len = 20
-        draw_masked_object(
-            variables=variables,
-            object_mask=background_mask,
+        plan.passes.append(plan_background(
+            variables,
+            background_mask,
+            touched_tiles,
+            split_len=background_split_len,
             skip_rate=variables.bg_object_skip_rate,
-        )
+        ))
     else:
-        #variables.split_len = 15
-        #variables.object_skip_rate = 8
         # draw the entire image without any mask
-        draw_masked_object(
-            variables=variables,
+        plan.passes.append(plan_masked_object(
+            variables,
             skip_rate=variables.object_skip_rate,
+        ))
+    return plan
+
+
+def composite_hand(variables, hand_coord_x, hand_coord_y):
+    """
+    Puts the hand on `variables.output_frame`, which is kept equal to
+    `drawn_frame` apart from the hand. Only the previous hand rectangle is
+    restored and only the new one is blended, so the cost depends on the
+    hand size and not on the video resolution.
+    """
+    if variables.hand_rect is not None:
+        variables.output_frame[variables.hand_rect] = variables.drawn_frame[variables.hand_rect]
+    crop_hand_ht = min(variables.hand_ht, variables.resize_ht - hand_coord_y)
+    crop_hand_wd = min(variables.hand_wd, variables.resize_wd - hand_coord_x)
+    variables.hand_rect = (
+        slice(hand_coord_y, hand_coord_y + crop_hand_ht),
+        slice(hand_coord_x, hand_coord_x + crop_hand_wd),
+    )
+    return draw_hand_on_img(
+        variables.output_frame,
+        variables.hand,
+        hand_coord_x,
+        hand_coord_y,
+        variables.hand_mask_inv,
+        variables.hand_ht,
+        variables.hand_wd,
+        variables.resize_ht,
+        variables.resize_wd,
+    )
+
+
+def composite_hand_in_place(variables, hand_coord_x, hand_coord_y):
+    """
+    Memory bounded version of `composite_hand`: the hand is blended into
+    `drawn_frame` itself and the pixels under it are kept in a hand sized
+    patch, `restore_hand_patch` puts them back after the frame is written.
+    """
+    crop_hand_ht = min(variables.hand_ht, variables.resize_ht - hand_coord_y)
+    crop_hand_wd = min(variables.hand_wd, variables.resize_wd - hand_coord_x)
+    variables.hand_rect = (
+        slice(hand_coord_y, hand_coord_y + crop_hand_ht),
+        slice(hand_coord_x, hand_coord_x + crop_hand_wd),
+    )
+    variables.hand_patch = variables.drawn_frame[variables.hand_rect].copy()
+    return draw_hand_on_img(
+        variables.drawn_frame,
+        variables.hand,
+        hand_coord_x,
+        hand_coord_y,
+        variables.hand_mask_inv,
+        variables.hand_ht,
+        variables.hand_wd,
+        variables.resize_ht,
+        variables.resize_wd,
+    )
+
+
+def restore_hand_patch(variables):
+    variables.drawn_frame[variables.hand_rect] = variables.hand_patch
+
+
+def draw_masked_object(
+    variables, object_mask=None, skip_rate=5, black_pixel_threshold=10, draw_pass=None
+):
+    """
+    skip_rate is not provided via variables because this function does not
+    know it is drawing object or background or an entire image.
+    A precomputed `draw_pass` skips the planning of the tile order.
+    """
+    print("Skip Rate: ", skip_rate)
+    if draw_pass is None:
+        draw_pass = plan_masked_object(
+            variables, object_mask, variables.split_len, skip_rate, black_pixel_threshold
         )
+    object_mask = draw_pass.mask
+    split_len = draw_pass.split_len
+    # the mask (box) starts at this tile, the plan tiles are frame tiles
+    tile_origin = (draw_pass.mask_origin[0] // split_len, draw_pass.mask_origin[1] // split_len)
+    mask_tiles = None
+    if variables.memory_bounded:
+        # no full size copies: tiles come from the threshold image itself &
+        # the object mask is applied to each batch
+        thresh_tiles = get_grid_of_cuts(variables.img_thresh, split_len)
+        if object_mask is not None:
+            mask_tiles = get_grid_of_cuts(object_mask, split_len)
+    else:
+        # 3 channel threshold image made once, then a tile is drawn by a plain copy
+        img_thresh = variables.img_thresh
+        if object_mask is not None:
+            img_thresh = get_mask_region(img_thresh, object_mask, draw_pass.mask_origin)
+        thresh_tiles = get_frame_tiles(
+            cv2.cvtColor(get_thresh_for_mask(img_thresh, object_mask), cv2.COLOR_GRAY2BGR),
+            split_len,
+        )
+    in_place_hand = variables.draw_hand and variables.memory_bounded
 
-    # User can select if they want a colour image or grayscale image shown at the end
-    if end_color:
-        end_img = variables.img
+    if draw_pass.n_inked > 0:
+        step_div = draw_pass.n_inked / 40
+        progress_step_no = 100 / step_div
     else:
-        end_img = cv2.cvtColor(variables.img_thresh, cv2.COLOR_GRAY2BGR)
+        progress_step_no = 0
+    print(f"Step interval: {progress_step_no}")
+    sk_progress = 0
 
-    # Ending the video with original original image
-    for i in range(variables.frame_rate * variables.end_gray_img_duration_in_sec):
-        #variables.video_object.write(variables.img)
-        variables.video_object.write(end_img)
+    if variables.draw_hand and not in_place_hand:
+        # drawn_frame was changed by the previous pass, sync the hand frame once
+        np.copyto(variables.output_frame, variables.drawn_frame)
+        variables.hand_rect = None
+    drawn_tiles = get_frame_tiles(variables.drawn_frame, split_len)
+    if variables.draw_hand and not in_place_hand:
+        output_tiles = get_frame_tiles(variables.output_frame, split_len)
+
+    # the tiles between two written frames are drawn together, and the hand is
+    # only composited for the frames which are written
+    tiles = draw_pass.tiles
+    frames = draw_pass.frame_bounds(skip_rate)
+    batch_ends = frames.tolist()
+    if not batch_ends or batch_ends[-1] != len(tiles):
+        batch_ends.append(len(tiles))
+    # frames before the frame window (segmented render) are not written,
+    # their tiles are replayed in one batch
+    frame_start, frame_stop = variables.frame_window or (0, None)
+    skip_frames = min(max(frame_start - variables.frame_index, 0), len(frames))
+    replayed_tiles = 0
+    if skip_frames:
+        replayed_tiles = batch_ends[skip_frames - 1]
+        batch_ends = batch_ends[skip_frames - 1:]
+        variables.frame_index += skip_frames
+    batch_start = 0
+    for batch_end in batch_ends:
+        if batch_end == batch_start:
+            continue
+        if frame_stop is not None and variables.frame_index >= frame_stop:
+            break
+        check_cancelled(variables)
+        rows = tiles[batch_start:batch_end, 0]
+        cols = tiles[batch_start:batch_end, 1]
+        if variables.memory_bounded:
+            batch_drawing = thresh_tiles[rows, cols]
+            if mask_tiles is not None:
+                batch_drawing = np.where(
+                    mask_tiles[rows - tile_origin[0], cols - tile_origin[1]] == 0, np.uint8(255), batch_drawing
+                )
+            batch_drawing = batch_drawing[..., None]
+        else:
+            batch_drawing = thresh_tiles[rows - tile_origin[0], cols - tile_origin[1]]
+        variables.stats.count("tiles_drawn", batch_end - batch_start)
+        drawn_tiles[rows, cols] = batch_drawing
+        if variables.draw_hand and not in_place_hand:
+            output_tiles[rows, cols] = batch_drawing
+
+        if batch_end % skip_rate == 0 and batch_end > replayed_tiles:
+            if variables.draw_hand:
+                hand_coord_x = int(cols[-1]) * split_len + int(split_len / 2)
+                hand_coord_y = int(rows[-1]) * split_len + int(split_len / 2)
+                if in_place_hand:
+                    drawn_frame_with_hand = composite_hand_in_place(variables, hand_coord_x, hand_coord_y)
+                else:
+                    drawn_frame_with_hand = composite_hand(variables, hand_coord_x, hand_coord_y)
+            else:
+                drawn_frame_with_hand = variables.drawn_frame
+            # the writers copy or encode the frame before `write` returns
+            variables.video_object.write(drawn_frame_with_hand)
+            if in_place_hand:
+                restore_hand_patch(variables)
+            variables.frame_index += 1
+
+        progress_ticks = batch_end // 40 - batch_start // 40
+        if progress_ticks:
+            sk_progress += progress_ticks * progress_step_no
+            if variables.progress_callback:
+                variables.progress_callback(sk_progress)
+        batch_start = batch_end
+
+    if object_mask is not None:
+        # a boolean mask, index arrays of np.where would take 16 bytes per pixel
+        np.copyto(
+            get_mask_region(variables.drawn_frame, object_mask, draw_pass.mask_origin),
+            get_mask_region(variables.img, object_mask, draw_pass.mask_origin),
+            where=(object_mask == 255)[..., None],
+        )
+    else:
+        variables.drawn_frame[:, :, :] = variables.img
+    check_memory_limit(variables)
+
+
+def get_pass_skip_rate(draw_pass, variables):
+    if draw_pass.kind == "background":
+        return variables.bg_object_skip_rate
+    return variables.object_skip_rate
+
+
+def count_video_frames(draw_plan, variables):
+    """ Number of frames the plan gives with the skip rates & end duration of variables """
+    drawing_frames = sum(
+        len(draw_pass.frame_bounds(get_pass_skip_rate(draw_pass, variables)))
+        for draw_pass in draw_plan.passes
+    )
+    return drawing_frames + variables.frame_rate * variables.end_gray_img_duration_in_sec
+
+
+def draw_whiteboard_animations(
+    img, mask_path, hand_path, hand_mask_path, save_video_path, variables, end_color=True,
+    draw_plan=None
+):
+    """
+    Renders the animation video. When `draw_plan` is given the tile order is
+    taken from it and `mask_path` is only used to check that the plan was
+    made with the same mask.
+    """
+    stats = variables.stats
+    try:
+        # reading the image and converting it to grayscale,
+        # computing clahe and later therholding
+        with stats.stage("preprocess"):
+            variables = preprocess_image(img=img, variables=variables)
+
+        # reading hand image and preprocess
+        with stats.stage("hand_load"):
+            variables = preprocess_hand_image(
+                hand_path=hand_path, hand_mask_path=hand_mask_path, variables=variables
+            )
+
+        # calculate how much time it takes to make video for 1 image
+        start_time = time.time()
+
+        with stats.stage("plan"):
+            if draw_plan is None:
+                draw_plan = plan_whiteboard_animation(variables, mask_path)
+            elif not draw_plan.matches(variables, mask_path):
+                raise ValueError("The draw plan was made for a different image, resolution, split length or mask")
+    except Exception:
+        # a direct encoder given by the caller is open already, it is closed before the caller deletes the file
+        if variables.video_object is not None:
+            abort_video_object(variables.video_object)
+        raise
+    variables.draw_plan = draw_plan
+    print(f"Planning done in: {time.time() - start_time}")
+
+    # defining the video object, unless a direct encoder (AvVideoWriter) was given
+    print(f"Selected platform in sketch api: {platform}")
+    if variables.video_object is None:
+        if platform == "android":
+            fourcc = cv2.VideoWriter_fourcc(*"MJPG") #mpg2 or h264 or MJPG
+        else:
+            fourcc = cv2.VideoWriter_fourcc(*"mp4v") #mp4v
+        variables.video_object = cv2.VideoWriter(
+            save_video_path,
+            fourcc,
+            variables.frame_rate,
+            (variables.resize_wd, variables.resize_ht),
+        )
+    if stats.enabled:
+        # innermost, so that it times the encoder itself when pipelined
+        variables.video_object = StatsFrameWriter(variables.video_object, stats)
+    if variables.pipelined:
+        variables.video_object = PipelinedFrameWriter(
+            variables.video_object, variables.img.shape, ring_size=get_ring_size(variables)
+        )
+    draw_start = time.perf_counter()
+    stats.begin_memory("draw")
+    try:
+        draw_video_frames(variables, draw_plan, end_color)
+    except Exception:
+        # cancelled or failed: the encoder is not flushed, the caller deletes the partial file
+        abort_video_object(variables.video_object)
+        stats.end_memory()
+        raise
 
     # Calculating the total execution time
     end_time = time.time()
     print("total time: ", end_time - start_time)
 
     # closing the video object
+    check_memory_limit(variables)
     variables.video_object.release()
+    if variables.pipelined:
+        stats.add_pipeline(variables.video_object.get_stats())
+    stats.add_time("draw", time.perf_counter() - draw_start)
+    stats.end_memory()
+
+
+def draw_video_frames(variables, draw_plan, end_color=True):
+    """ Draws the passes of the plan & holds the end image, into variables.video_object """
+    # creating an emtpy frame and select 0th index as the starting point to draw
+    variables.drawn_frame = np.full(variables.img.shape, 255, np.uint8)
+    if variables.draw_hand and not variables.memory_bounded:
+        # persistent frame with the hand on it, see composite_hand
+        variables.output_frame = variables.drawn_frame.copy()
+        variables.hand_rect = None
+
+    variables.frame_index = 0
+    frame_start, frame_stop = variables.frame_window or (0, None)
+    for draw_pass in draw_plan.passes:
+        if frame_stop is not None and variables.frame_index >= frame_stop:
+            break
+        if draw_pass.kind == "background":
+            print("Drawing the blakground region..")
+        draw_masked_object(
+            variables=variables,
+            skip_rate=get_pass_skip_rate(draw_pass, variables),
+            draw_pass=draw_pass,
+        )
+
+    # User can select if they want a colour image or grayscale image shown at the end
+    if end_color:
+        end_img = variables.img
+    elif variables.memory_bounded:
+        # the canvas is not needed any more
+        end_img = cv2.cvtColor(variables.img_thresh, cv2.COLOR_GRAY2BGR, dst=variables.drawn_frame)
+    else:
+        end_img = cv2.cvtColor(variables.img_thresh, cv2.COLOR_GRAY2BGR)
+
+    # Ending the video with original original image
+    end_frames = variables.frame_rate * variables.end_gray_img_duration_in_sec
+    end_start = max(frame_start - variables.frame_index, 0)
+    end_stop = end_frames if frame_stop is None else min(end_frames, frame_stop - variables.frame_index)
+    #variables.video_object.write(variables.img)
+    write_held_frame(variables.video_object, end_img, end_stop - end_start, variables.cancel_event)
+    variables.frame_index += end_frames
 
 def find_nearest_res(given):
     arr = np.array([640, 360, 480, 1280, 720, 1920, 1080, 2560, 1440, 3840, 2160, 7680, 4320])
     idx = (np.abs(arr - given)).argmin()  # Find index of minimum difference
     return arr[idx]
 
+def get_padding_box(w, h, target_width, target_height):
+    """ (left, top, width, height) of a w x h image in the padded target frame """
+    # scale ratio (keep aspect ratio)
+    scale = min(target_width / w, target_height / h)
+    # new size
+    new_w = int(w * scale)
+    new_h = int(h * scale)
+    return (target_width - new_w) // 2, (target_height - new_h) // 2, new_w, new_h
+
 def resize_with_padding(img, target_width, target_height, color=(255,255,255)):
     """
     Resize image to target resolution keeping aspect ratio.
@@ -391,31 +963,69 @@ def resize_with_padding(img, target_width, target_height, color=(255,255,255)):
     """
 
     h, w = img.shape[:2]
-    # scale ratio (keep aspect ratio)
-    scale = min(target_width / w, target_height / h)
-    # new size
-    new_w = int(w * scale)
-    new_h = int(h * scale)
-    # resize image
-    resized = cv2.resize(img, (new_w, new_h), interpolation=cv2.INTER_AREA)
-    # compute padding
-    pad_w = target_width - new_w
-    pad_h = target_height - new_h
-    top = pad_h // 2
-    bottom = pad_h - top
-    left = pad_w // 2
-    right = pad_w - left
-
-    # add border (padding)
-    padded = cv2.copyMakeBorder(
-        resized,
-        top, bottom, left, right,
-        cv2.BORDER_CONSTANT,
-        value=color
+    left, top, new_w, new_h = get_padding_box(w, h, target_width, target_height)
+    # the image is resized straight into the padded frame, no separate border copy
+    padded = np.full((target_height, target_width) + img.shape[2:], color, dtype=img.dtype)
+    cv2.resize(
+        img, (new_w, new_h), dst=padded[top : top + new_h, left : left + new_w], interpolation=cv2.INTER_AREA
     )
     return padded
 
 
+def get_reduced_decode_flag(image_path, source_size, box_size):
+    """
+    cv2.IMREAD_REDUCED_COLOR_* flag which still decodes at least `box_size`.
+    Only JPEG decoders scale while decoding, other formats would be decoded
+    fully & resized once more.
+    """
+    try:
+        with open(image_path, "rb") as file:
+            if file.read(2) != b"\xff\xd8":
+                return cv2.IMREAD_COLOR
+    except OSError:
+        return cv2.IMREAD_COLOR
+    for factor, flag in ((8, cv2.IMREAD_REDUCED_COLOR_8), (4, cv2.IMREAD_REDUCED_COLOR_4), (2, cv2.IMREAD_REDUCED_COLOR_2)):
+        # libjpeg rounds the scaled size up
+        if -(-source_size[0] // factor) >= box_size[0] and -(-source_size[1] // factor) >= box_size[1]:
+            return flag
+    return cv2.IMREAD_COLOR
+
+
+def read_video_image(image_path, max_1080p=True):
+    """
+    Decodes the image at the video resolution with one resample: large JPEGs
+    are decoded at 1/2, 1/4 or 1/8 size & padded images are resized straight
+    into the frame. Returns (image, (source width, height), image_box), the
+    image box is (left, top, width, height) of padded images, otherwise None.
+    """
+    source_size = probe_image_size(image_path)
+    img_wd, img_ht = get_target_res(*source_size, max_1080p)
+    image_box = None
+    box_size = (img_wd, img_ht)
+    if max_1080p and max(source_size) > 1920:
+        image_box = get_padding_box(*source_size, img_wd, img_ht)
+        box_size = image_box[2:]
+    flag = get_reduced_decode_flag(image_path, source_size, box_size)
+    image_bgr = cv2.imread(image_path, flag)
+    if image_bgr is None and flag != cv2.IMREAD_COLOR:
+        image_bgr = cv2.imread(image_path)
+    if image_bgr is None:
+        raise ValueError(f"Can not read the image: {image_path}")
+    if flag != cv2.IMREAD_COLOR:
+        print(f"Reduced decode: {source_size[0]} x {source_size[1]} -> {image_bgr.shape[1]} x {image_bgr.shape[0]}")
+    elif (image_bgr.shape[1], image_bgr.shape[0]) != source_size:
+        # the header did not tell the decoded size, e.g. an unusual EXIF
+        source_size = (image_bgr.shape[1], image_bgr.shape[0])
+        img_wd, img_ht = get_target_res(*source_size, max_1080p)
+        image_box = get_padding_box(*source_size, img_wd, img_ht) if max_1080p and max(source_size) > 1920 else None
+    if image_box is not None:
+        image_bgr = resize_with_padding(image_bgr, img_wd, img_ht)
+    elif (image_bgr.shape[1], image_bgr.shape[0]) != (img_wd, img_ht):
+        # the same resample preprocess_image did before
+        image_bgr = cv2.resize(image_bgr, (img_wd, img_ht))
+    return image_bgr, source_size, image_box
+
+
 class AllVariables:
     def __init__(
         self,
@@ -427,6 +1037,9 @@ class AllVariables:
         bg_object_skip_rate=None,
         end_gray_img_duration_in_sec=None,
         draw_hand=True,
+        pipelined=False,
+        memory_bounded=False,
+        hand_scale=None,
     ):
         self.frame_rate = frame_rate
         self.resize_wd = resize_wd
@@ -436,37 +1049,722 @@ class AllVariables:
         self.bg_object_skip_rate = bg_object_skip_rate
         self.end_gray_img_duration_in_sec = end_gray_img_duration_in_sec
         self.draw_hand = draw_hand
+        self.hand_scale = hand_scale  # size of the hand image, None is relative to 1080p (see get_hand_scale)
+        self.source_size = None  # (width, height) of the image file, set by render_sketch
+        self.image_box = None  # (left, top, width, height) of the padded image in the frame
+        self.pipelined = pipelined  # encode on a separate thread, see PipelinedFrameWriter
+        self.progress_callback = None  # plain callable, gets the drawing progress in %
+        self.video_object = None
+        self.frame_window = None  # (start, stop) frames to write, for segmented renders
+        self.frame_index = 0
+        self.stats = RenderStats(enabled=False)
+        self.memory_bounded = memory_bounded  # one canvas & no full size temporaries, see estimate_render_memory_mb
+        self.memory_limit_mb = None  # reported by check_memory_limit when the render goes over it
+        self.memory_limit_hit = False
+        self.memory_estimate_mb = None  # set when even the memory bounded estimate is over memory_limit_mb
+        self.rss_baseline_mb = None
+        self.cancel_event = None  # stops the render once set, see check_cancelled
+
+
+class RenderCancelled(Exception):
+    """ The cancel_event of the render was set """
+
+
+def check_cancelled(variables):
+    """
+    Raises RenderCancelled when variables.cancel_event is set. The event is
+    anything with is_set(): a threading or multiprocessing Event.
+    """
+    if variables.cancel_event is not None and variables.cancel_event.is_set():
+        raise RenderCancelled("Render cancelled")
+
+
+class RenderStats:
+    """
+    Named stage timers (seconds) & counters of one render. When disabled the
+    calls are kept but nothing is recorded.
+    With track_memory every stage also records the RSS, the peak of the
+    traced allocations during the stage, the live numpy buffers and the top
+    allocation sites at its end. It uses tracemalloc, which slows the render
+    down, so it is meant for hunting memory problems.
+    """
+
+    def __init__(self, enabled=True, track_memory=False, top_sites=5):
+        self.enabled = enabled or track_memory
+        self.track_memory = track_memory
+        self.top_sites = top_sites
+        self.timers = {}
+        self.counters = {}
+        self.peaks = {}
+        self.memory = {}
+        self.pipeline = {}  # queue depth & waits of the PipelinedFrameWriter, see add_pipeline
+        self.memory_stack = []  # [stage name, RSS & traced memory at the start, traced peak] of the open stages
+        self.started_tracing = False
+
+    @contextlib.contextmanager
+    def timed_stage(self, name):
+        start = time.perf_counter()
+        self.begin_memory(name)
+        try:
+            yield
+        finally:
+            self.add_time(name, time.perf_counter() - start)
+            self.end_memory()
+
+    def begin_memory(self, name):
+        if not self.track_memory:
+            return
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self.started_tracing = True
+        # the peak is reset for every stage, the open outer stages keep theirs
+        traced_now, traced_peak = tracemalloc.get_traced_memory()
+        for stage in self.memory_stack:
+            stage[3] = max(stage[3], traced_peak)
+        tracemalloc.reset_peak()
+        self.memory_stack.append([name, get_rss_mb(), traced_now, 0])
+
+    def end_memory(self):
+        if not self.track_memory or not self.memory_stack:
+            return
+        name, rss_start_mb, traced_start, traced_peak = self.memory_stack.pop()
+        traced_peak = max(traced_peak, tracemalloc.get_traced_memory()[1])
+        for stage in self.memory_stack:
+            stage[3] = max(stage[3], traced_peak)
+
+        snapshot = tracemalloc.take_snapshot().filter_traces(
+            [tracemalloc.Filter(False, tracemalloc.__file__)]
+        )
+        numpy_traces = snapshot.filter_traces(
+            [tracemalloc.DomainFilter(True, np.lib.tracemalloc_domain)]
+        ).traces
+        top_sites = []
+        for site_stat in snapshot.statistics("lineno")[: self.top_sites]:
+            frame = site_stat.traceback[0]
+            top_sites.append({
+                "site": f"{os.path.basename(frame.filename)}:{frame.lineno}",
+                "mb": round(site_stat.size / (1024 * 1024), 2),
+                "count": site_stat.count,
+            })
+        rss_mb = get_rss_mb()
+        record = {
+            "rss_mb": None if rss_mb is None else round(rss_mb, 1),
+            "rss_delta_mb": None if rss_mb is None or rss_start_mb is None else round(rss_mb - rss_start_mb, 1),
+            "traced_peak_mb": round(traced_peak / (1024 * 1024), 2),
+            # the most the stage allocated on top of what was there before it
+            "traced_growth_mb": round((traced_peak - traced_start) / (1024 * 1024), 2),
+            "numpy_buffers": len(numpy_traces),
+            "numpy_mb": round(sum(trace.size for trace in numpy_traces) / (1024 * 1024), 2),
+            "top_sites": top_sites,
+        }
+        # a repeated stage keeps its most memory hungry run
+        if name not in self.memory or record["traced_peak_mb"] >= self.memory[name]["traced_peak_mb"]:
+            self.memory[name] = record
+        if rss_mb is not None:
+            self.peak("rss_mb", rss_mb)
+
+    def stop_memory_tracking(self):
+        """ Stops tracemalloc if these stats started it & adds the process peak RSS """
+        if not self.track_memory:
+            return
+        if self.started_tracing:
+            tracemalloc.stop()
+            self.started_tracing = False
+        try:
+            import resource
+            max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            # kilobytes on Linux, bytes on macOS
+            self.peak("process_max_rss_mb", max_rss / (1024 * 1024 if sys.platform == "darwin" else 1024))
+        except ImportError:
+            pass  # Windows
+
+    def stage(self, name):
+        """ `with stats.stage("preprocess"):` adds the time of the block to the stage """
+        if not self.enabled:
+            return contextlib.nullcontext()
+        return self.timed_stage(name)
+
+    def add_time(self, name, seconds):
+        if self.enabled:
+            self.timers[name] = self.timers.get(name, 0.0) + seconds
+
+    def count(self, name, value=1):
+        if self.enabled:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def peak(self, name, value):
+        """ Keeps the highest value seen, e.g. memory use """
+        if self.enabled and value > self.peaks.get(name, value - 1):
+            self.peaks[name] = value
+
+    def add_pipeline(self, pipeline_stats):
+        """ Adds the get_stats() of a PipelinedFrameWriter, those of the segments add up """
+        if not self.enabled:
+            return
+        old = self.pipeline
+        writes = old.get("writes", 0) + pipeline_stats["writes"]
+        depth_total = (
+            old.get("avg_queue_depth", 0) * old.get("writes", 0)
+            + pipeline_stats["avg_queue_depth"] * pipeline_stats["writes"]
+        )
+        self.pipeline = {
+            "ring_size": max(old.get("ring_size", 0), pipeline_stats["ring_size"]),
+            "frames": old.get("frames", 0) + pipeline_stats["frames"],
+            "writes": writes,
+            "avg_queue_depth": round(depth_total / writes, 2) if writes else 0,
+            "max_queue_depth": max(old.get("max_queue_depth", 0), pipeline_stats["max_queue_depth"]),
+            "draw_wait_sec": round(old.get("draw_wait_sec", 0) + pipeline_stats["draw_wait_sec"], 3),
+            "encode_wait_sec": round(old.get("encode_wait_sec", 0) + pipeline_stats["encode_wait_sec"], 3),
+        }
+
+    def merge(self, stats_dict):
+        """ Adds the as_dict() output of another render, e.g. of a segment worker """
+        for name, seconds in stats_dict.get("stages", {}).items():
+            self.add_time(name, seconds)
+        for name, value in stats_dict.get("counters", {}).items():
+            self.count(name, value)
+        for name, value in stats_dict.get("peaks", {}).items():
+            self.peak(name, value)
+        if stats_dict.get("pipeline"):
+            self.add_pipeline(stats_dict["pipeline"])
+
+    def as_dict(self):
+        stats_dict = {
+            "stages": {name: round(seconds, 4) for name, seconds in self.timers.items()},
+            "counters": dict(self.counters),
+            "peaks": {name: round(value, 1) for name, value in self.peaks.items()},
+        }
+        if self.pipeline:
+            stats_dict["pipeline"] = dict(self.pipeline)
+        if self.track_memory:
+            stats_dict["memory"] = self.memory
+        return stats_dict
+
+
+class StatsFrameWriter:
+    """ Wraps the real video writer to time the encoding & count the frames """
+
+    def __init__(self, video_object, stats):
+        self.video_object = video_object
+        self.stats = stats
+
+    def isOpened(self):
+        return self.video_object.isOpened()
+
+    # timed directly, not with stats.stage: that would take a memory snapshot per frame
+    def write(self, frame):
+        start = time.perf_counter()
+        self.video_object.write(frame)
+        self.stats.add_time("encode", time.perf_counter() - start)
+        self.stats.count("frames_written")
+
+    def hold(self, frame, n_frames, cancel_event=None):
+        start = time.perf_counter()
+        write_held_frame(self.video_object, frame, n_frames, cancel_event)
+        self.stats.add_time("encode", time.perf_counter() - start)
+        self.stats.count("frames_written", n_frames)
+
+    def release(self):
+        start = time.perf_counter()
+        self.video_object.release()
+        self.stats.add_time("encode", time.perf_counter() - start)
+
+    def abort(self):
+        abort_video_object(self.video_object)
+
+
+def append_stats_log(log_path, record):
+    """ Appends one JSON line, batch workers may share the file """
+    with open(log_path, "a") as file:
+        file.write(json.dumps(record) + "\n")
+
+def get_rss_mb():
+    """ Resident memory of this process, None where there is no /proc (Windows, macOS) """
+    try:
+        with open("/proc/self/statm") as file:
+            resident_pages = int(file.read().split()[1])
+    except (OSError, ValueError, IndexError):
+        return None
+    return resident_pages * os.sysconf("SC_PAGE_SIZE") / (1024 * 1024)
+
+
+def get_available_memory_mb():
+    """ MemAvailable of Linux & Android, None elsewhere """
+    try:
+        with open("/proc/meminfo") as file:
+            for line in file:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) / 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    return None
+
+
+def get_ring_size(variables):
+    """ Frame buffers of PipelinedFrameWriter, None is its own default """
+    return 2 if variables.memory_bounded else None
+
+
+def estimate_render_memory_mb(
+    img_wd, img_ht, draw_hand=True, memory_bounded=False, pipelined=False
+):
+    """
+    Rough peak memory of one render on top of the running app. The H.264
+    encoder dominates at high resolutions: libx264 keeps ~120 frames for its
+    lookahead & threads, ~50 with the low memory options of AvVideoWriter.
+    """
+    frame_mb = img_wd * img_ht * 3 / (1024 * 1024)
+    gray_mb = frame_mb / 3
+    yuv_mb = gray_mb * 1.5
+    if memory_bounded:
+        # img, the canvas & the threshold image
+        memory_mb = 2 * frame_mb + gray_mb + 50 * yuv_mb
+    else:
+        # img, the canvas, the hand frame, the 3 channel threshold, gray & threshold images
+        memory_mb = (3 + int(bool(draw_hand))) * frame_mb + 2 * gray_mb + 120 * yuv_mb
+    if pipelined:
+        ring_size = 2 if memory_bounded else max(2, min(8, 64 // max(1, int(frame_mb))))
+        memory_mb += ring_size * frame_mb
+    return memory_mb
+
+
+def check_memory_limit(variables):
+    """ Records the memory used by the render & reports when it is over `memory_limit_mb` """
+    if variables.rss_baseline_mb is None:
+        return
+    rss_mb = get_rss_mb()
+    if rss_mb is None:
+        return
+    used_mb = rss_mb - variables.rss_baseline_mb
+    variables.stats.peak("render_memory_mb", used_mb)
+    if variables.memory_limit_mb and used_mb > variables.memory_limit_mb:
+        if not variables.memory_limit_hit:
+            print(f"Memory limit hit: the render uses {used_mb:.0f} MB, the limit is {variables.memory_limit_mb:.0f} MB")
+        variables.memory_limit_hit = True
+        variables.stats.count("memory_limit_hit")
+
 
 def common_divisors(num1, num2):
     """
     Finds all common divisors of two numbers, stores them in a list,
     and returns the list sorted in ascending order.
     """
-    divisors1 = []
-    divisors2 = []
-    common_divs = []
+    # the common divisors are the divisors of the gcd, pairs up to its square root
+    gcd = np.gcd(int(num1), int(num2)).item()
+    small_divs = []
+    large_divs = []
+    i = 1
+    while i * i <= gcd:
+        if gcd % i == 0:
+            small_divs.append(i)
+            if i * i != gcd:
+                large_divs.append(gcd // i)
+        i += 1
+    return small_divs + large_divs[::-1]
+
+
+class AvVideoWriter:
+    """
+    Encodes the BGR numpy frames straight to H.264 with PyAV in a single pass.
+    It has the `write` / `release` calls of cv2.VideoWriter, so the drawing code
+    does not care which one it got. Raises if PyAV or the encoder is missing,
+    then the caller falls back to cv2.VideoWriter + ffmpeg_convert.
+    """
+
+    def __init__(self, save_video_path, frame_rate, frame_size, platform="linux", low_memory=False):
+        import av
+        self.av = av
+        self.container = av.open(save_video_path, mode="w")
+        try:
+            # same encoder selection & quality as ffmpeg_convert
+            if platform == "android":
+                self.stream = self.container.add_stream("libx264", rate=frame_rate)
+            else:
+                self.stream = self.container.add_stream("h264", rate=frame_rate)
+            self.stream.width = frame_size[0]
+            self.stream.height = frame_size[1]
+            self.stream.pix_fmt = "yuv420p"
+            self.stream.options = {"crf": "20"}
+            if low_memory:
+                # the lookahead & frame threads hold most of the encoder memory
+                self.stream.options = {"crf": "20", "rc-lookahead": "5", "threads": "2"}
+            self.time_base = Fraction(1, int(frame_rate))
+            self.stream.codec_context.time_base = self.time_base
+        except Exception:
+            self.container.close()
+            raise
+        self.frame_count = 0
+        # consecutive frames at both ends of a hold, more than the B-frame delay of x264
+        self.hold_edge_frames = 4
+        print(f"PyAV writer: {av.__version__}, codec: {self.stream.codec_context.name}")
+
+    def isOpened(self):
+        return True
+
+    def write(self, frame):
+        av_frame = self.av.VideoFrame.from_ndarray(frame, format="bgr24")
+        av_frame.pts = self.frame_count
+        av_frame.time_base = self.time_base
+        for packet in self.stream.encode(av_frame):
+            self.container.mux(packet)
+        self.frame_count += 1
+
+    def hold(self, frame, n_frames, cancel_event=None):
+        """
+        Shows `frame` for `n_frames` through the timestamps instead of encoding
+        it n_frames times: once per second (so seeking finds it quickly) and as
+        the first & last few frames. The decode timestamps trail the B-frame
+        reordering by a few frames, so those have to be consecutive: at the
+        end to keep the MP4 duration, which comes from the last decode
+        timestamp. At the start because x264 extrapolates the first decode
+        timestamps of a video from the gaps of its first frames, a segment
+        starting in a hold would go back before the previous segment (see
+        concat_video_segments).
+        """
+        if n_frames <= 0:
+            return
+        hold_end = self.frame_count + n_frames
+        hold_step = max(1, int(round(1 / self.time_base)))
+        head_end = min(hold_end, self.frame_count + self.hold_edge_frames)
+        tail_start = max(self.frame_count, hold_end - self.hold_edge_frames)
+        hold_pts = sorted(
+            set(range(self.frame_count, hold_end, hold_step))
+            | set(range(self.frame_count, head_end))
+            | set(range(tail_start, hold_end))
+        )
+        for pts in hold_pts:
+            if cancel_event is not None and cancel_event.is_set():
+                raise RenderCancelled("Render cancelled")
+            av_frame = self.av.VideoFrame.from_ndarray(frame, format="bgr24")
+            av_frame.pts = pts
+            av_frame.time_base = self.time_base
+            for packet in self.stream.encode(av_frame):
+                self.container.mux(packet)
+        self.frame_count = hold_end
+
+    def release(self):
+        for packet in self.stream.encode(None):
+            self.container.mux(packet)
+        self.container.close()
+
+    def abort(self):
+        """ Closes the file without flushing the frames still in the encoder """
+        self.container.close()
+
+
+def write_held_frame(video_object, frame, n_frames, cancel_event=None):
+    """ Writes the same frame n_frames times, as timestamps when the writer supports it """
+    if hasattr(video_object, "hold"):
+        video_object.hold(frame, n_frames, cancel_event)
+    else:
+        # cv2.VideoWriter is constant frame rate only
+        for i in range(n_frames):
+            if cancel_event is not None and cancel_event.is_set():
+                raise RenderCancelled("Render cancelled")
+            video_object.write(frame)
+
+
+class AnyEvent:
+    """ is_set() of several events at once, None entries are left out """
+
+    def __init__(self, *events):
+        self.events = [event for event in events if event is not None]
+
+    def is_set(self):
+        return any(event.is_set() for event in self.events)
+
+
+def abort_video_object(video_object):
+    """ Closes the writer of a cancelled render, cv2.VideoWriter has release only """
+    try:
+        if hasattr(video_object, "abort"):
+            video_object.abort()
+        else:
+            video_object.release()
+    except Exception as e:
+        print(f"Video writer abort error: {e}")
+
+
+class PipelinedFrameWriter:
+    """
+    Runs the encoder of another writer (cv2.VideoWriter or AvVideoWriter) on
+    its own thread so drawing and encoding overlap. Frames are copied into a
+    small ring of preallocated buffers; `write` only blocks when every buffer
+    is still waiting for the encoder.
+    The queue depth tells which side is slow: mostly empty means drawing is
+    the bottleneck, mostly full means encoding is, see get_stats.
+    """
+
+    def __init__(self, video_object, frame_shape, ring_size=None, max_ring_bytes=64 * 1024 * 1024):
+        frame_bytes = int(np.prod(frame_shape))
+        if ring_size is None:
+            ring_size = max(2, min(8, max_ring_bytes // frame_bytes))
+        self.video_object = video_object
+        self.buffers = [np.empty(frame_shape, np.uint8) for _ in range(ring_size)]
+        self.free_slots = queue.Queue()
+        self.ready_slots = queue.Queue()
+        for slot in range(ring_size):
+            self.free_slots.put(slot)
+        self.error = None
+        self.aborted = threading.Event()  # the frames still in the ring are dropped
+        self.frames = 0
+        self.writes = 0
+        self.depth_total = 0
+        self.depth_max = 0
+        self.draw_wait = 0.0  # time drawing waited for a free buffer
+        self.encode_wait = 0.0  # time encoder waited for a frame
+        self.encoder_thread = threading.Thread(target=self.encode_loop, daemon=True)
+        self.encoder_thread.start()
+
+    def isOpened(self):
+        return True
+
+    def write(self, frame):
+        self.hold(frame, 1)
+
+    def hold(self, frame, n_frames, cancel_event=None):
+        if self.error is not None:
+            raise self.error
+        if n_frames <= 0:
+            return
+        wait_start = time.perf_counter()
+        slot = self.free_slots.get()
+        self.draw_wait += time.perf_counter() - wait_start
+        np.copyto(self.buffers[slot], frame)
+        self.ready_slots.put((slot, n_frames, cancel_event))
+        depth = self.ready_slots.qsize()
+        self.frames += n_frames
+        self.writes += 1
+        self.depth_total += depth
+        self.depth_max = max(self.depth_max, depth)
+
+    def encode_loop(self):
+        while True:
+            wait_start = time.perf_counter()
+            item = self.ready_slots.get()
+            self.encode_wait += time.perf_counter() - wait_start
+            if item is None:
+                break
+            slot, n_frames, cancel_event = item
+            if self.error is None and not self.aborted.is_set():
+                try:
+                    if n_frames == 1:
+                        self.video_object.write(self.buffers[slot])
+                    else:
+                        # checked per frame: with the cv2 writer a long hold is encoded frame by frame
+                        write_held_frame(
+                            self.video_object, self.buffers[slot], n_frames, AnyEvent(self.aborted, cancel_event)
+                        )
+                except RenderCancelled as e:
+                    if not self.aborted.is_set():
+                        # the render was cancelled during the hold, `release` raises it
+                        self.error = e
+                except Exception as e:
+                    # keep draining so that `write` never blocks forever
+                    self.error = e
+            self.free_slots.put(slot)
+
+    def get_stats(self):
+        """ Ring use of the render, see RenderStats.add_pipeline """
+        return {
+            "ring_size": len(self.buffers),
+            "frames": self.frames,
+            "writes": self.writes,
+            "avg_queue_depth": round(self.depth_total / self.writes, 2) if self.writes else 0,
+            "max_queue_depth": self.depth_max,
+            "draw_wait_sec": round(self.draw_wait, 3),
+            "encode_wait_sec": round(self.encode_wait, 3),
+        }
+
+    def release(self):
+        self.ready_slots.put(None)
+        self.encoder_thread.join()
+        if isinstance(self.error, RenderCancelled):
+            # no need to flush the encoder, the caller deletes the file
+            abort_video_object(self.video_object)
+            raise self.error
+        self.video_object.release()
+        if self.error is not None:
+            raise self.error
+
+    def abort(self):
+        self.aborted.set()
+        self.ready_slots.put(None)
+        self.encoder_thread.join()
+        abort_video_object(self.video_object)
+
+
+def get_mp_context():
+    """
+    forkserver where it is available, spawn on Windows. Both start the
+    workers from a fresh process, not by forking the multithreaded app. The
+    workers import the main module again as __mp_main__, the app's main.py
+    only loads Kivy under its __main__ guard.
+    """
+    if "forkserver" in multiprocessing.get_all_start_methods():
+        mp_context = multiprocessing.get_context("forkserver")
+        # imported once by the fork server, the workers start without loading cv2 & numpy again
+        mp_context.set_forkserver_preload(["sketchApi"])
+        return mp_context
+    return multiprocessing.get_context("spawn")
+
 
-    # Find divisors of num1
-    for i in range(1, num1 + 1):
-        if num1 % i == 0:
-            divisors1.append(i)
+# cancels the segments of a render, set in each worker process by init_segment_worker
+segment_cancel_event = None
 
-    # Find divisors of num2
-    for i in range(1, num2 + 1):
-        if num2 % i == 0:
-            divisors2.append(i)
 
-    # Find common divisors
-    for divisor in divisors1:
-        if divisor in divisors2:
-            common_divs.append(divisor)
+def init_segment_worker(cancel_event=None):
+    global segment_cancel_event
+    segment_cancel_event = cancel_event
 
-    common_divs.sort()  # Sort the list in ascending order
-    return common_divs
 
+def render_video_segment(
+    img, hand_path, hand_mask_path, segment_path, settings, end_color, draw_plan, frame_window,
+    which_platform="linux", mask_path=None
+):
+    """
+    Runs in a worker process: renders & encodes the frames of `frame_window`
+    only, returns the stats of the worker
+    """
+    global platform
+    platform = which_platform
+    variables = AllVariables(**settings)
+    variables.frame_window = frame_window
+    variables.cancel_event = segment_cancel_event
+    variables.stats = RenderStats()
+    # the same encoder settings in every segment: concat_video_segments keeps
+    # the parameter sets (SPS/PPS) of the first one only
+    variables.video_object = AvVideoWriter(
+        segment_path, variables.frame_rate, (variables.resize_wd, variables.resize_ht), platform
+    )
+    draw_whiteboard_animations(
+        img, mask_path, hand_path, hand_mask_path, segment_path, variables, end_color, draw_plan
+    )
+    return variables.stats.as_dict()
 
-def ffmpeg_convert(source_vid, dest_vid, platform="linux"):
+
+def concat_video_segments(segment_paths, dest_vid, segment_durations):
+    """
+    Joins H.264 segments (each starts with a key frame) into one MP4 without
+    re-encoding, the timestamps of every segment are moved after the previous.
+    The stream keeps the parameter sets of the first segment, all of them
+    must be encoded with the same settings.
+    segment_durations: length of every segment in seconds (Fraction). The
+    packet durations can not tell it, the duration of a reordered B-frame
+    before a held frame spans the hold gap.
+    """
+    import av
+    output_container = av.open(dest_vid, mode="w")
+    try:
+        out_stream = None
+        ts_offset = 0
+        last_dts = None
+        for segment_path, segment_duration in zip(segment_paths, segment_durations):
+            with av.open(segment_path, mode="r") as input_container:
+                in_stream = input_container.streams.video[0]
+                if out_stream is None:
+                    if hasattr(output_container, "add_stream_from_template"):
+                        out_stream = output_container.add_stream_from_template(in_stream)
+                    else:
+                        out_stream = output_container.add_stream(template=in_stream)  # PyAV < 14
+                for packet in input_container.demux(in_stream):
+                    if packet.dts is None:
+                        continue  # demuxer flush packet
+                    packet.pts += ts_offset
+                    packet.dts += ts_offset
+                    if last_dts is not None and packet.dts <= last_dts:
+                        raise ValueError(f"The decode timestamps of {segment_path} overlap the previous segment")
+                    last_dts = packet.dts
+                    packet.stream = out_stream
+                    output_container.mux(packet)
+                ts_offset += round(segment_duration / in_stream.time_base)
+    finally:
+        output_container.close()
+
+
+def render_segmented(
+    img, mask_path, hand_path, hand_mask_path, save_video_path, variables, end_color, draw_plan, segments
+):
+    """
+    Splits the frame timeline of one video into `segments` contiguous parts.
+    Every part is rendered & encoded in its own process, starting from the
+    canvas rebuilt by replaying the earlier tiles, and the parts are joined
+    into `save_video_path` without re-encoding. Needs PyAV.
+    """
+    stats = variables.stats
+    with stats.stage("preprocess"):
+        variables = preprocess_image(img=img, variables=variables)
+    with stats.stage("plan"):
+        if draw_plan is None:
+            draw_plan = plan_whiteboard_animation(variables, mask_path)
+        elif not draw_plan.matches(variables, mask_path):
+            raise ValueError("The draw plan was made for a different image, resolution, split length or mask")
+    variables.draw_plan = draw_plan
+
+    total_frames = count_video_frames(draw_plan, variables)
+    frame_cuts = sorted(set(np.linspace(0, total_frames, segments + 1).astype(int).tolist()))
+    settings = {
+        "frame_rate": variables.frame_rate,
+        "resize_wd": variables.resize_wd,
+        "resize_ht": variables.resize_ht,
+        "split_len": variables.split_len,
+        "object_skip_rate": variables.object_skip_rate,
+        "bg_object_skip_rate": variables.bg_object_skip_rate,
+        "end_gray_img_duration_in_sec": variables.end_gray_img_duration_in_sec,
+        "draw_hand": variables.draw_hand,
+        "hand_scale": variables.hand_scale,
+    }
+    video_base, video_ext = os.path.splitext(save_video_path)
+    segment_paths = [f"{video_base}_part{i}{video_ext}" for i in range(len(frame_cuts) - 1)]
+    print(f"Rendering {total_frames} frames in {len(segment_paths)} segments")
+    mp_context = get_mp_context()
+    # the event of the caller may be a threading.Event, the workers get their own
+    cancel_event = mp_context.Event()
+    try:
+        with ProcessPoolExecutor(
+            max_workers=len(segment_paths), mp_context=mp_context,
+            initializer=init_segment_worker, initargs=(cancel_event,),
+        ) as executor:
+            futures = [
+                executor.submit(
+                    render_video_segment, img, hand_path, hand_mask_path, segment_path, settings,
+                    end_color, draw_plan, (frame_start, frame_stop), platform, mask_path
+                )
+                for segment_path, frame_start, frame_stop in zip(segment_paths, frame_cuts, frame_cuts[1:])
+            ]
+            pending = set(futures)
+            while pending:
+                done, pending = wait(pending, timeout=0.1, return_when=FIRST_COMPLETED)
+                if variables.cancel_event is not None and variables.cancel_event.is_set():
+                    cancel_event.set()
+                for future in done:
+                    try:
+                        # the stage times of the workers add up, like CPU time
+                        stats.merge(future.result())
+                    except Exception:
+                        # the other segments are of no use any more
+                        cancel_event.set()
+                        raise
+                    if variables.progress_callback:
+                        variables.progress_callback(100 * (len(futures) - len(pending)) / len(futures))
+        with stats.stage("concat"):
+            concat_video_segments(segment_paths, save_video_path, [
+                Fraction(frame_stop - frame_start, int(variables.frame_rate))
+                for frame_start, frame_stop in zip(frame_cuts, frame_cuts[1:])
+            ])
+    finally:
+        for segment_path in segment_paths:
+            if os.path.exists(segment_path):
+                os.unlink(segment_path)
+
+
+def ffmpeg_convert(source_vid, dest_vid, platform="linux", cancel_event=None):
+    """
+    Re-encodes the cv2 video to H.264, returns True on success. Raises
+    RenderCancelled (without dest_vid) once cancel_event is set.
+    """
     ff_stat = False
+    input_container = output_container = None
     try:
         import av
         # ---> diagnostic code
@@ -505,6 +1803,8 @@ def ffmpeg_convert(source_vid, dest_vid, platform="linux"):
         #print("Selected codec: ", out_stream.codec_context.codec.name)
         # <--- diag end
         for frame in input_container.decode(video=0):
+            if cancel_event is not None and cancel_event.is_set():
+                raise RenderCancelled("Render cancelled")
             packet = out_stream.encode(frame)
             if packet:
                 output_container.mux(packet)
@@ -517,52 +1817,247 @@ def ffmpeg_convert(source_vid, dest_vid, platform="linux"):
         print(f"ffmpeg convert success, converted file: {dest_vid}")
         ff_stat = True
     except Exception as e:
+        # no truncated dest_vid is left next to the raw video
+        for container in (output_container, input_container):
+            if container is not None:
+                with contextlib.suppress(Exception):
+                    container.close()
+        remove_partial_videos(dest_vid)
+        if isinstance(e, RenderCancelled):
+            raise
         print(f"ffmpeg convert error: {e}")
     return ff_stat
 
+
+def remove_partial_videos(*video_paths):
+    """ Deletes the files of a failed or cancelled render """
+    for video_path in video_paths:
+        try:
+            if os.path.exists(video_path):
+                os.unlink(video_path)
+        except OSError as e:
+            print(f"Could not remove {video_path}: {e}")
+
+def get_video_base_name():
+    """
+    Unique video file name (without extension). Date & time alone collide
+    when batch workers finish within the same second.
+    """
+    now = datetime.datetime.now()
+    current_time = str(now.strftime("%H%M%S"))
+    current_date = str(now.strftime("%Y%m%d"))
+    return f"vid_{current_date}_{current_time}_{uuid.uuid4().hex[:8]}"
+
+
+def get_file_stamp(path):
+    """ Identity of an input file that is cheaper than hashing it, like the hand cache uses """
+    if not path:
+        return None
+    return [os.path.abspath(path), os.path.getsize(path), os.path.getmtime(path)]
+
+
+def get_render_cache_key(image_bgr, settings, mask_path=None):
+    """
+    Hash of the decoded image & every setting which changes the video.
+    Settings which only change the speed or memory use of a render
+    (pipelined, segments, memory_bounded) are left out of `settings`.
+    """
+    digest = hashlib.sha1(np.ascontiguousarray(image_bgr).tobytes())
+    digest.update(repr(image_bgr.shape).encode())
+    digest.update(json.dumps(settings, sort_keys=True).encode())
+    if mask_path:
+        with open(mask_path, "rb") as file:
+            digest.update(file.read())
+    return digest.hexdigest()
+
+
+class RenderCache:
+    """
+    Finished videos by render cache key (see get_render_cache_key), kept in
+    a folder of the video dir as hard links of the rendered files. The
+    modification time of an empty "<key>.used" file next to each video is
+    its last use, not the one of the video: the outputs share its inode.
+    The least recently used videos are deleted once the folder is over
+    `max_mb`. Files are only added by rename, so batch worker processes can
+    share the folder.
+    """
+
+    def __init__(self, cache_dir, max_mb=1024):
+        self.cache_dir = cache_dir
+        self.max_mb = max_mb
+
+    def get_path(self, key):
+        return os.path.join(self.cache_dir, f"{key}.mp4")
+
+    @staticmethod
+    def get_used_path(cache_path):
+        return f"{os.path.splitext(cache_path)[0]}.used"
+
+    def touch(self, cache_path):
+        """ Records the last use for the LRU order """
+        used_path = self.get_used_path(cache_path)
+        with open(used_path, "a"):
+            pass
+        os.utime(used_path)
+
+    def get(self, key, video_path):
+        """ Links the cached video to video_path, returns False if there is none """
+        cache_path = self.get_path(key)
+        if not os.path.exists(cache_path):
+            return False
+        try:
+            if os.path.lexists(video_path):
+                os.unlink(video_path)
+            link_or_copy(cache_path, video_path)
+            self.touch(cache_path)
+        except OSError as e:
+            print(f"Render cache read error: {e}")
+            return False
+        return True
+
+    def put(self, key, video_path):
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            temp_path = f"{self.get_path(key)}.{uuid.uuid4().hex[:8]}.tmp"
+            link_or_copy(video_path, temp_path)
+            os.replace(temp_path, self.get_path(key))
+            self.touch(self.get_path(key))
+            self.evict()
+        except OSError as e:
+            print(f"Render cache write error: {e}")
+
+    def list_entries(self):
+        entries = []
+        for entry in os.scandir(self.cache_dir):
+            if entry.name.endswith(".mp4"):
+                try:
+                    file_stat = entry.stat()
+                except OSError:
+                    continue  # deleted by another worker
+                try:
+                    last_use = os.stat(self.get_used_path(entry.path)).st_mtime
+                except OSError:
+                    last_use = file_stat.st_mtime  # not touched yet
+                entries.append((last_use, file_stat.st_size, entry.path))
+        return entries
+
+    def evict(self):
+        """ Deletes the least recently used videos until the cache fits max_mb """
+        entries = sorted(self.list_entries())
+        total_size = sum(size for _, size, _ in entries)
+        max_size = self.max_mb * 1024 * 1024
+        for _, size, path in entries:
+            if total_size <= max_size:
+                break
+            with contextlib.suppress(OSError):
+                os.unlink(path)
+                print(f"Render cache: removed {path}")
+            with contextlib.suppress(OSError):
+                os.unlink(self.get_used_path(path))
+            total_size -= size
+
+    def clear(self):
+        if os.path.isdir(self.cache_dir):
+            shutil.rmtree(self.cache_dir, ignore_errors=True)
+
+
+def get_render_cache(video_dir, max_mb=1024):
+    return RenderCache(os.path.join(video_dir, ".sketch_cache"), max_mb)
+
+
+def link_or_copy(source_path, dest_path):
+    """ Hard link, or a copy where the file system has no links (e.g. Android shared storage) """
+    try:
+        os.link(source_path, dest_path)
+    except OSError:
+        shutil.copyfile(source_path, dest_path)
+
 def initiate_sketch(
-        image_path, split_len, frame_rate, object_skip_rate, bg_object_skip_rate, main_img_duration, callback, save_path=save_path,
+        image_path, split_len, frame_rate, object_skip_rate, bg_object_skip_rate, main_img_duration, callback,
+        **kwargs):
+    """
+    Runs `render_sketch`, passes the result to `callback` & returns it.
+    callback & progress_callback are plain callables called from the render
+    thread, the app moves them to the Kivy clock itself.
+    """
+    final_result = render_sketch(
+        image_path, split_len, frame_rate, object_skip_rate, bg_object_skip_rate, main_img_duration, **kwargs
+    )
+    if callback:
+        callback(final_result)
+    return final_result
+
+def render_sketch(
+        image_path, split_len, frame_rate, object_skip_rate, bg_object_skip_rate, main_img_duration, save_path=save_path,
         which_platform="linux", end_color=True, draw_hand=True, max_1080p=True,
-        progress_callback=None ):
+        progress_callback=None, plan_path=None, pipelined=None, output_path=None, segments=1,
+        collect_stats=True, stats_log_path=None, memory_bounded=False, memory_limit_mb=None,
+        track_memory=False, custom_hand_path=None, custom_hand_mask_path=None, hand_scale=None,
+        mask_path=None, use_cache=False, cache_max_mb=1024, cancel_event=None ):
+    """
+    Renders the sketch video of one image & returns {"status", "message",
+    "stats"}, message is the video path on success.
+    output_path: exact path of the video, by default a unique name in save_path.
+    plan_path: optional draw plan file (.npz). If it exists the tile order is
+    loaded from it, otherwise the plan made for this render is saved there.
+    pipelined: encode on a separate thread while drawing. By default it is
+    used on desktops with more than one core.
+    segments: render parts of the video in this many processes at once (see
+    render_segmented), needs PyAV.
+    collect_stats: add the stage timers & counters as "stats" (see RenderStats).
+    The "draw" stage includes the writer calls, "encode" is the time inside
+    the encoder. stats_log_path: also append them to this JSON-lines file.
+    memory_bounded: one canvas, no full size temporaries & a low memory
+    encoder, for 4K/8K on small devices. memory_limit_mb: switch to the
+    memory bounded mode when the estimate is over it, warn when even that is
+    over it ("memory_estimate_mb" is set then), and report when the measured
+    use goes over it ("memory_limit_hit").
+    track_memory: add the memory use of every stage to the stats (slow, see
+    RenderStats).
+    custom_hand_path: own hand image, with custom_hand_mask_path or as a PNG
+    with alpha. hand_scale: size of the hand image, by default it is scaled
+    with the video like the bundled hand at 1080p.
+    mask_path: LabelMe JSON of the image, every shape is drawn as its own
+    object before the background (see find_labelme_mask).
+    use_cache: return the video of an earlier render of the same image &
+    settings from the render cache of save_path ("cache_hit" is set then),
+    cache_max_mb bounds its size (see RenderCache). Off by default, the cache
+    is a hidden folder in save_path or next to output_path.
+    cancel_event: threading or multiprocessing Event, once it is set the
+    render stops within a frame (or within ~1000 tiles of the planning),
+    deletes its partial files & returns with "cancelled" set.
+    """
     global platform
     platform = which_platform
     final_result = {"status": False, "message": "Initial load"}
+    stats = RenderStats(enabled=collect_stats or bool(stats_log_path), track_memory=track_memory)
+    video_size = None
+    variables = None
+    rss_baseline_mb = get_rss_mb()
     try:
-        image_bgr = cv2.imread(image_path)
-        mask_path = None # To be added later
+        with stats.stage("image_decode"):
+            image_bgr, source_size, image_box = read_video_image(image_path, max_1080p)
         # video save path
-        now = datetime.datetime.now()
-        current_time = str(now.strftime("%H%M%S"))
-        current_date = str(now.strftime("%Y%m%d"))
+        if output_path:
+            save_path = os.path.dirname(os.path.abspath(output_path))
+            video_base_name = f"{os.path.splitext(os.path.basename(output_path))[0]}_raw"
+        else:
+            video_base_name = get_video_base_name()
         if platform == "android":
-            video_save_name = f"vid_{current_date}_{current_time}.avi" #mpg
+            video_save_name = f"{video_base_name}.avi" #mpg
         else:
-            video_save_name = f"vid_{current_date}_{current_time}.mp4" #mp4
+            video_save_name = f"{video_base_name}.mp4" #mp4
         save_video_path = os.path.join(save_path, video_save_name)
-        ffmpeg_file_name = f"vid_{current_date}_{current_time}_h264.mp4"
-        ffmpeg_video_path = os.path.join(save_path, ffmpeg_file_name)
+        if output_path:
+            ffmpeg_video_path = os.path.abspath(output_path)
+        else:
+            ffmpeg_file_name = f"{video_base_name}_h264.mp4"
+            ffmpeg_video_path = os.path.join(save_path, ffmpeg_file_name)
         os.makedirs(os.path.dirname(save_video_path), exist_ok=True)
         print("save_video_path: ", save_video_path)
 
-        # Get image width & height. If the resolution is not standard & split length is not a common divisor, get the nearest standard res
+        # the image is already at the video resolution (see get_target_res)
         img_ht, img_wd = image_bgr.shape[0], image_bgr.shape[1]
-        if max_1080p and (img_ht > 1920 or img_wd > 1920):
-            if img_wd > img_ht: # 16:9
-                img_wd = 1920
-                img_ht = 1080
-            else: # 9:16
-                img_ht = 1920
-                img_wd = 1080
-            image_bgr = resize_with_padding(
-                img=image_bgr,
-                target_width=img_wd,
-                target_height=img_ht
-            )
-        else:
-            aspect_ratio = img_wd / img_ht
-            img_ht = find_nearest_res(img_ht)
-            new_aspect_wd = int(img_ht * aspect_ratio)
-            img_wd = find_nearest_res(new_aspect_wd)
         print(f"Target width: {img_wd} x height: {img_ht}")
 
         # constants and variables object
@@ -576,56 +2071,292 @@ def initiate_sketch(
             bg_object_skip_rate = bg_object_skip_rate,  # assuming background region is larger, hence increasing the skip rate
             end_gray_img_duration_in_sec = main_img_duration,  # the last few secs of the video, for every image will have the entire original image shown as is
             draw_hand=draw_hand,
+            hand_scale=hand_scale,
         )
+        # the mask shapes are moved like the image
+        variables.source_size = source_size
+        variables.image_box = image_box
+        if custom_hand_path:
+            render_hand_path, render_hand_mask_path = custom_hand_path, custom_hand_mask_path
+        else:
+            render_hand_path, render_hand_mask_path = hand_path, hand_mask_path
+        video_size = [int(img_wd), int(img_ht)]
+
+        render_cache = None
+        if use_cache:
+            with stats.stage("cache"):
+                render_cache = get_render_cache(save_path, cache_max_mb)
+                cache_key = get_render_cache_key(image_bgr, {
+                    "split_len": split_len,
+                    "frame_rate": frame_rate,
+                    "object_skip_rate": object_skip_rate,
+                    "bg_object_skip_rate": bg_object_skip_rate,
+                    "main_img_duration": main_img_duration,
+                    "end_color": end_color,
+                    "draw_hand": draw_hand,
+                    "max_1080p": max_1080p,
+                    "platform": platform,
+                    "hand": [get_file_stamp(render_hand_path), get_file_stamp(render_hand_mask_path), hand_scale]
+                    if draw_hand else None,
+                }, mask_path)
+                cache_hit = render_cache.get(cache_key, ffmpeg_video_path)
+            if cache_hit:
+                print(f"Render cache hit: {ffmpeg_video_path}")
+                final_result = {"status": True, "message": f"{ffmpeg_video_path}", "cache_hit": True}
+                if progress_callback:
+                    progress_callback(100)
+                return finish_render_result(final_result, stats, variables, stats_log_path, image_path, video_size)
+        if pipelined is None:
+            pipelined = platform != "android" and (os.cpu_count() or 1) > 1
+        variables.pipelined = pipelined
+        variables.stats = stats
+        variables.memory_bounded = memory_bounded
+        if memory_limit_mb:
+            estimate_mb = estimate_render_memory_mb(
+                img_wd, img_ht, draw_hand, memory_bounded, pipelined
+            )
+            if estimate_mb > memory_limit_mb and not memory_bounded:
+                variables.memory_bounded = True
+                estimate_mb = estimate_render_memory_mb(img_wd, img_ht, draw_hand, True, pipelined)
+                print(f"Memory limit {memory_limit_mb:.0f} MB: using the memory bounded mode")
+            if estimate_mb > memory_limit_mb:
+                # only a rough guess, the render goes on & check_memory_limit reports the real use
+                variables.memory_estimate_mb = estimate_mb
+                print(
+                    f"Warning: the video may need about {estimate_mb:.0f} MB, "
+                    f"the memory limit is {memory_limit_mb:.0f} MB"
+                )
+            variables.memory_limit_mb = memory_limit_mb
+            # every segment process needs the memory of a whole render
+            segments = max(1, min(segments, int(memory_limit_mb // estimate_mb)))
+        variables.rss_baseline_mb = rss_baseline_mb
 
         # invoking the drawing function
-        global progress_updater
-        progress_updater = progress_callback
+        variables.progress_callback = progress_callback
+        variables.cancel_event = cancel_event
+        draw_plan = None
+        if plan_path and os.path.exists(plan_path):
+            with stats.stage("file_io"):
+                draw_plan = DrawPlan.load(plan_path)
         try:
-            draw_whiteboard_animations(
-                image_bgr, mask_path, hand_path, hand_mask_path, save_video_path, variables,
-                end_color
-            )
-            try:
-                ff_stat = ffmpeg_convert(source_vid=save_video_path, dest_vid=ffmpeg_video_path, platform=platform)
-                if ff_stat:
-                    final_result = {"status": True, "message": f"{ffmpeg_video_path}"}
-                    os.unlink(save_video_path)
-                    print(f"removed raw video: {save_video_path}")
-                else:
+            # the segments would each need the memory of a full render
+            if segments > 1 and not variables.memory_bounded and importlib.util.find_spec("av") is not None:
+                render_segmented(
+                    image_bgr, mask_path, render_hand_path, render_hand_mask_path, ffmpeg_video_path, variables,
+                    end_color, draw_plan, segments
+                )
+                direct_h264 = True
+            else:
+                # encode H.264 directly, cv2.VideoWriter + ffmpeg_convert is the fallback
+                try:
+                    variables.video_object = AvVideoWriter(
+                        ffmpeg_video_path, frame_rate, (img_wd, img_ht), platform, variables.memory_bounded
+                    )
+                except Exception as e:
+                    print(f"PyAV writer is not available, using cv2 writer: {e}")
+                direct_h264 = variables.video_object is not None
+                draw_whiteboard_animations(
+                    image_bgr, mask_path, render_hand_path, render_hand_mask_path, save_video_path, variables,
+                    end_color, draw_plan
+                )
+            if plan_path and draw_plan is None:
+                with stats.stage("file_io"):
+                    variables.draw_plan.save(plan_path)
+            if direct_h264:
+                final_result = {"status": True, "message": f"{ffmpeg_video_path}"}
+            else:
+                try:
+                    with stats.stage("convert"):
+                        ff_stat = ffmpeg_convert(
+                            source_vid=save_video_path, dest_vid=ffmpeg_video_path, platform=platform,
+                            cancel_event=cancel_event
+                        )
+                    if ff_stat:
+                        final_result = {"status": True, "message": f"{ffmpeg_video_path}"}
+                        with stats.stage("file_io"):
+                            os.unlink(save_video_path)
+                        print(f"removed raw video: {save_video_path}")
+                    else:
+                        final_result = {"status": True, "message": f"{save_video_path}"}
+                except RenderCancelled:
+                    raise
+                except Exception as e:
+                    print(f"FFMPEG Error: {e}")
                     final_result = {"status": True, "message": f"{save_video_path}"}
-            except Exception as e:
-                print(f"FFMPEG Error: {e}")
-                final_result = {"status": True, "message": f"{save_video_path}"}
+        except RenderCancelled:
+            remove_partial_videos(save_video_path, ffmpeg_video_path)
+            print(f"Render cancelled: {image_path}")
+            final_result = {"status": False, "message": "Cancelled", "cancelled": True}
         except Exception as e:
+            # e.g. a failed segment concat, no truncated video is left in save_path
+            remove_partial_videos(save_video_path, ffmpeg_video_path)
             print(f"Error: {e}")
             final_result = {"status": False, "message": f"Error: {e}"}
+        # only finished H.264 videos, not the raw video of a failed conversion
+        if render_cache is not None and final_result["status"] and final_result["message"] == ffmpeg_video_path:
+            with stats.stage("cache"):
+                render_cache.put(cache_key, ffmpeg_video_path)
 
     except Exception as e:
         print(f"Error: {e}")
         final_result = {"status": False, "message": f"Error: {e}"}
-    Clock.schedule_once(lambda dt: callback(final_result))
+    return finish_render_result(final_result, stats, variables, stats_log_path, image_path, video_size)
+
+
+def finish_render_result(final_result, stats, variables, stats_log_path, image_path, video_size):
+    """ Adds the stats to a render_sketch result & logs them """
+    stats.stop_memory_tracking()
+    if variables is not None and variables.memory_limit_hit:
+        final_result["memory_limit_hit"] = True
+    if variables is not None and variables.memory_estimate_mb is not None:
+        final_result["memory_estimate_mb"] = round(variables.memory_estimate_mb)
+    if stats.enabled:
+        final_result["stats"] = stats.as_dict()
+        print(f"Render stats: {final_result['stats']}")
+    if stats_log_path:
+        try:
+            append_stats_log(stats_log_path, {
+                "time": datetime.datetime.now().isoformat(timespec="seconds"),
+                "image_path": image_path,
+                "status": final_result["status"],
+                "video_size": video_size,
+                "platform": platform,
+                **final_result["stats"],
+            })
+        except Exception as e:
+            print(f"Stats log error: {e}")
+    return final_result
+
+def get_target_res(img_wd, img_ht, max_1080p=True):
+    """
+    Video (width, height) of an image. If the resolution is not standard &
+    split length is not a common divisor, get the nearest standard res.
+    Images over 1920 are padded to 1080p when max_1080p is set.
+    """
+    if max_1080p and (img_ht > 1920 or img_wd > 1920):
+        if img_wd > img_ht: # 16:9
+            return 1920, 1080
+        # 9:16
+        return 1080, 1920
+    aspect_ratio = img_wd / img_ht
+    img_ht = find_nearest_res(img_ht)
+    new_aspect_wd = int(img_ht * aspect_ratio)
+    img_wd = find_nearest_res(new_aspect_wd)
+    return int(img_wd), int(img_ht)
+
+
+def read_jpeg_size(file):
+    """ (width, height) from the SOF segment, swapped for EXIF rotations like cv2.imread does """
+    if file.read(2) != b"\xff\xd8":
+        return None
+    swap = False
+    while True:
+        byte = file.read(1)
+        if not byte:
+            return None
+        if byte != b"\xff":
+            continue
+        marker = file.read(1)
+        while marker == b"\xff":  # fill bytes
+            marker = file.read(1)
+        if not marker:
+            return None
+        marker = marker[0]
+        if marker == 0xD8 or marker == 0x01 or 0xD0 <= marker <= 0xD7:
+            continue  # no length
+        length_bytes = file.read(2)
+        if len(length_bytes) < 2:
+            return None
+        length = int.from_bytes(length_bytes, "big") - 2
+        if 0xC0 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):
+            header = file.read(5)
+            if len(header) < 5:
+                return None
+            ht, wd = int.from_bytes(header[1:3], "big"), int.from_bytes(header[3:5], "big")
+            return (ht, wd) if swap else (wd, ht)
+        if marker == 0xE1:
+            segment = file.read(length)
+            # orientations 5-8 are rotated by 90 degrees
+            swap = get_exif_orientation(segment) in (5, 6, 7, 8)
+        elif marker == 0xD9 or marker == 0xDA:
+            return None  # no frame header before the scan
+        else:
+            file.seek(length, os.SEEK_CUR)
+
+
+def get_exif_orientation(segment):
+    if not segment.startswith(b"Exif\x00\x00"):
+        return None
+    tiff = segment[6:]
+    byte_order = {b"II": "little", b"MM": "big"}.get(tiff[:2])
+    if byte_order is None or len(tiff) < 8:
+        return None
+    ifd_offset = int.from_bytes(tiff[4:8], byte_order)
+    if ifd_offset + 2 > len(tiff):
+        return None
+    n_entries = int.from_bytes(tiff[ifd_offset : ifd_offset + 2], byte_order)
+    for i in range(n_entries):
+        entry = tiff[ifd_offset + 2 + i * 12 : ifd_offset + 14 + i * 12]
+        if len(entry) < 12:
+            return None
+        if int.from_bytes(entry[:2], byte_order) == 0x0112:
+            return int.from_bytes(entry[8:10], byte_order)
+    return None
+
+
+def read_png_size(header):
+    if header[:8] != b"\x89PNG\r\n\x1a\n" or header[12:16] != b"IHDR":
+        return None
+    return int.from_bytes(header[16:20], "big"), int.from_bytes(header[20:24], "big")
+
+
+def read_webp_size(header):
+    if header[:4] != b"RIFF" or header[8:12] != b"WEBP":
+        return None
+    chunk = header[12:16]
+    if chunk == b"VP8 " and header[23:26] == b"\x9d\x01\x2a":
+        return (
+            int.from_bytes(header[26:28], "little") & 0x3FFF,
+            int.from_bytes(header[28:30], "little") & 0x3FFF,
+        )
+    if chunk == b"VP8L" and header[20:21] == b"\x2f":
+        bits = int.from_bytes(header[21:25], "little")
+        return (bits & 0x3FFF) + 1, ((bits >> 14) & 0x3FFF) + 1
+    if chunk == b"VP8X":
+        return int.from_bytes(header[24:27], "little") + 1, int.from_bytes(header[27:30], "little") + 1
+    return None
+
+
+def probe_image_size(image_path):
+    """
+    (width, height) of an image as cv2.imread would decode it, read from the
+    file header of JPEG/PNG/WebP files. Other files are decoded.
+    """
+    size = None
+    try:
+        with open(image_path, "rb") as file:
+            header = file.read(32)
+            if header[:2] == b"\xff\xd8":
+                file.seek(0)
+                size = read_jpeg_size(file)
+            else:
+                size = read_png_size(header) or read_webp_size(header)
+    except OSError:
+        pass
+    if size and size[0] > 0 and size[1] > 0:
+        return size
+    image_bgr = cv2.imread(image_path)
+    if image_bgr is None:
+        raise ValueError(f"Can not read the image: {image_path}")
+    return image_bgr.shape[1], image_bgr.shape[0]
+
 
 def get_split_lens(image_path, max_1080p=True):
     """ Get image width & height. If the resolution is not standard & split length is not a common divisor, get the nearest standard resolution """
     final_return = {"image_res": [], "split_lens": []}
     hcf_list = []
     try:
-        image_bgr = cv2.imread(image_path)
-        #image_bgr = cv2.cvtColor(image, cv2.COLOR_RGB2BGR)
-        img_ht, img_wd = image_bgr.shape[0], image_bgr.shape[1]
-        if max_1080p and (img_ht > 1920 or img_wd > 1920):
-            if img_wd > img_ht: # 16:9
-                img_wd = 1920
-                img_ht = 1080
-            else: # 9:16
-                img_ht = 1920
-                img_wd = 1080
-        else:
-            aspect_ratio = img_wd / img_ht
-            img_ht = find_nearest_res(img_ht)
-            new_aspect_wd = int(img_ht * aspect_ratio)
-            img_wd = find_nearest_res(new_aspect_wd)
+        img_wd, img_ht = get_target_res(*probe_image_size(image_path), max_1080p)
         hcf_list = common_divisors(img_ht, img_wd)
         # update the results
         final_return["split_lens"] = hcf_list
@@ -634,4 +2365,188 @@ def get_split_lens(image_path, max_1080p=True):
         print(f"Error while getting split len: {e}")
     return final_return # list of split length
 
+
+def probe_images(image_paths, max_1080p=True, workers=8):
+    """
+    get_split_lens of many images at once, the header reads are I/O bound so
+    threads are enough. Returns the results in the order of image_paths,
+    with "image_path" added.
+    """
+    def probe(image_path):
+        return {"image_path": image_path, **get_split_lens(image_path, max_1080p)}
+
+    with ThreadPoolExecutor(max_workers=max(1, min(workers, len(image_paths)))) as executor:
+        return list(executor.map(probe, image_paths))
+
+
+def add_render_args(parser):
+    parser.add_argument("--split-len", type=int, default=10, help="tile size in pixels (video speed), default: 10")
+    parser.add_argument("--frame-rate", type=int, default=25, help="default: 25")
+    parser.add_argument("--object-skip-rate", type=int, default=8, help="default: 8")
+    parser.add_argument("--bg-skip-rate", type=int, default=14, help="background skip rate, default: 14")
+    parser.add_argument("--end-duration", type=int, default=2, help="seconds the original image is shown at the end, default: 2")
+    parser.add_argument("--end-gray", action="store_true", help="show the sketch instead of the colour image at the end")
+    parser.add_argument("--no-hand", action="store_true", help="do not draw the hand")
+    parser.add_argument("--full-res", action="store_true", help="do not limit the video to 1080p")
+    parser.add_argument("--stats-log", help="append the stage timings of every render to this JSON-lines file")
+    parser.add_argument("--low-memory", action="store_true", help="memory bounded render, for 4K/8K on small devices")
+    parser.add_argument("--memory-limit", type=float, help="memory ceiling of a render in MB")
+    parser.add_argument("--track-memory", action="store_true", help="add the memory use of every stage to the stats (slow)")
+    parser.add_argument("--hand", help="own hand image, a PNG with alpha or with --hand-mask")
+    parser.add_argument("--hand-mask", help="mask of the --hand image, white is the hand")
+    parser.add_argument("--hand-scale", type=float, help="size of the hand image, default: scaled with the video")
+    parser.add_argument("--no-mask", action="store_true", help="ignore the LabelMe JSON next to the image")
+    # opt-in, the cache is a hidden folder of copies/links next to the output
+    parser.add_argument("--cache", action="store_true", help="reuse the videos of earlier renders from a cache in the output folder")
+    parser.add_argument("--cache-max-mb", type=float, default=1024, help="size of the --cache folder, default: 1024")
+
+
+def get_render_kwargs(args):
+    return {
+        "split_len": args.split_len,
+        "frame_rate": args.frame_rate,
+        "object_skip_rate": args.object_skip_rate,
+        "bg_object_skip_rate": args.bg_skip_rate,
+        "main_img_duration": args.end_duration,
+        "end_color": not args.end_gray,
+        "draw_hand": not args.no_hand,
+        "max_1080p": not args.full_res,
+        "stats_log_path": args.stats_log,
+        "memory_bounded": args.low_memory,
+        "memory_limit_mb": args.memory_limit,
+        "track_memory": args.track_memory,
+        "custom_hand_path": args.hand,
+        "custom_hand_mask_path": args.hand_mask,
+        "hand_scale": args.hand_scale,
+        "use_sidecar_mask": not args.no_mask,
+        "use_cache": args.cache,
+        "cache_max_mb": args.cache_max_mb,
+    }
+
+
+def main(argv=None):
+    """
+    Headless entry point, it does not need Kivy:
+        python -m sketchApi render in.jpg -o out.mp4 --split-len 10
+        python -m sketchApi batch images/ -o videos/ --workers 4
+    """
+    import argparse
+    parser = argparse.ArgumentParser(prog="sketchApi", description="Whiteboard sketch animation from images")
+    commands = parser.add_subparsers(dest="command", required=True)
+    render_parser = commands.add_parser("render", help="render one image")
+    render_parser.add_argument("image")
+    render_parser.add_argument("-o", "--output", help="video path, default: <image name>_sketch.mp4")
+    render_parser.add_argument("--plan", help="draw plan file (.npz) to reuse or to create")
+    render_parser.add_argument("--segments", type=int, default=1, help="render parts of the video in parallel processes")
+    render_parser.add_argument("--mask", help="LabelMe JSON of the objects, default: <image name>.json if it exists")
+    add_render_args(render_parser)
+    batch_parser = commands.add_parser("batch", help="render every image of a folder")
+    batch_parser.add_argument("folder")
+    batch_parser.add_argument("-o", "--output", help="output folder, default: <folder>/sketches")
+    batch_parser.add_argument("--workers", type=int, default=None, help="parallel images, default: cores - 1")
+    batch_parser.add_argument("--resume", action="store_true", help="skip the images an interrupted run of this folder finished")
+    add_render_args(batch_parser)
+    args = parser.parse_args(argv)
+    with get_cli_result_stream() as results:
+        return run_cli_command(parser, args, results)
+
+
+@contextlib.contextmanager
+def get_cli_result_stream():
+    """
+    Stream of the JSON results of the CLI, one per line on stdout. Every
+    other print of the render goes to stderr while it runs: file descriptor
+    1 is pointed at stderr, so the worker processes & the encoder libraries
+    write there too, and the results get a copy of the old stdout.
+    """
+    sys.stdout.flush()
+    try:
+        stdout_fd = sys.stdout.fileno()
+        saved_fd = os.dup(stdout_fd)
+        os.dup2(sys.stderr.fileno(), stdout_fd)
+    except (AttributeError, OSError, ValueError):
+        # no file descriptors (e.g. captured output), only the prints of this process move
+        results, sys.stdout = sys.stdout, sys.stderr
+        try:
+            yield results
+        finally:
+            sys.stdout = results
+        return
+    results = os.fdopen(os.dup(saved_fd), "w", buffering=1)
+    try:
+        yield results
+    finally:
+        sys.stdout.flush()
+        results.close()
+        os.dup2(saved_fd, stdout_fd)
+        os.close(saved_fd)
+
+
+def run_cli_command(parser, args, results):
+    render_kwargs = get_render_kwargs(args)
+
+    if args.command == "render":
+        split_info = get_split_lens(args.image, render_kwargs["max_1080p"])
+        if split_info["split_lens"] and args.split_len not in split_info["split_lens"]:
+            parser.error(f"--split-len must be one of {split_info['split_lens']} for this image")
+        output = args.output or f"{os.path.splitext(os.path.basename(args.image))[0]}_sketch.mp4"
+        if render_kwargs.pop("use_sidecar_mask") and not args.mask:
+            args.mask = find_labelme_mask(args.image)
+        result = render_sketch(
+            args.image,
+            output_path=output,
+            plan_path=args.plan,
+            segments=args.segments,
+            mask_path=args.mask,
+            progress_callback=lambda value: print(f"progress: {value:.0f}%", file=sys.stderr),
+            **render_kwargs,
+        )
+        print(json.dumps(result), file=results)
+        return 0 if result["status"] else 1
+
+    # batch: images are rendered in parallel worker processes
+    from sketchBatch import BatchRenderer, BatchManifest, list_batch_images, get_batch_manifest_dir, find_resumable_batch
+    output_dir = args.output or os.path.join(args.folder, "sketches")
+    render_kwargs["save_path"] = output_dir
+    manifest_dir = get_batch_manifest_dir(output_dir)
+    manifest = find_resumable_batch(manifest_dir, args.folder) if args.resume else None
+    if manifest is not None:
+        # the settings of the interrupted run, so all videos of the batch match
+        render_kwargs = manifest.render_kwargs
+        print(f"Resuming {manifest.path}: {len(manifest.done_files())} images are done", file=sys.stderr)
+    else:
+        image_paths = [os.path.join(args.folder, file) for file in list_batch_images(args.folder)]
+        manifest = BatchManifest.create(manifest_dir, args.folder, image_paths, render_kwargs)
+    image_paths = manifest.pending_paths()
+    all_done = threading.Event()
+    renderer = BatchRenderer(
+        image_paths,
+        render_kwargs,
+        workers=args.workers,
+        on_result=lambda result: print(json.dumps(result), file=results, flush=True),
+        on_done=lambda results: all_done.set(),
+        manifest=manifest,
+    )
+    renderer.start()
+    try:
+        while not all_done.wait(0.5):
+            pass
+    except KeyboardInterrupt:
+        # the running images are cancelled within a frame, they stay pending for --resume
+        renderer.stop()
+        all_done.wait()
+    finally:
+        renderer.close()
+    failed = [result for result in renderer.results if not result["status"]]
+    n_videos = len(manifest.done_files())
+    print(f"{n_videos} of {len(manifest.data['files'])} videos in {output_dir}", file=sys.stderr)
+    if failed or renderer.stopped:
+        return 1
+    manifest.remove()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
+
 # End
\ No newline at end of file
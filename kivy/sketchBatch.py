@@ -0,0 +1,698 @@
+import os
+import json
+import uuid
+import queue
+import shutil
+import datetime
+import threading
+import zipfile
+import heapq
+import itertools
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import cv2
+
+from sketchApi import render_sketch, get_mp_context, find_labelme_mask
+
+img_extensions = [".png", ".jpg", ".jpeg", ".webp"]
+
+
+def is_android():
+    """ Same check as kivy.utils.platform, sys.platform is "linux" there too """
+    return "ANDROID_ARGUMENT" in os.environ
+
+
+def get_default_workers():
+    """
+    Leave one core for the UI & the encoder threads. One at a time on
+    Android, where the images render in threads of the app & phones throttle
+    under a sustained load on every core.
+    """
+    if is_android():
+        return 1
+    return max(1, (os.cpu_count() or 2) - 1)
+
+
+def list_batch_images(image_folder):
+    img_file_list = []
+    for file in sorted(os.listdir(image_folder)):
+        file_path_wo_ext, ext = os.path.splitext(file)
+        if ext.lower() in img_extensions:
+            img_file_list.append(file)
+    return img_file_list
+
+
+def get_batch_manifest_dir(video_dir):
+    return os.path.join(video_dir, ".batches")
+
+
+class BatchManifest:
+    """
+    A batch on disk: the images, the render settings and the status & video
+    of every image. It is rewritten after every finished image, so a batch
+    stopped by a crash or by closing the app can be resumed from it.
+    """
+
+    version = 1
+
+    def __init__(self, path, data):
+        self.path = path
+        self.data = data
+        self.lock = threading.Lock()
+
+    @classmethod
+    def create(cls, manifest_dir, image_folder, image_paths, render_kwargs, package_mode="zip"):
+        """ package_mode: "zip" or "folder", see BatchPackager """
+        os.makedirs(manifest_dir, exist_ok=True)
+        batch_id = f"bat_{datetime.datetime.now().strftime('%Y%m%d_%H%M%S')}_{uuid.uuid4().hex[:8]}"
+        manifest = cls(os.path.join(manifest_dir, f"{batch_id}.json"), {
+            "version": cls.version,
+            "batch_id": batch_id,
+            "created": datetime.datetime.now().isoformat(timespec="seconds"),
+            "image_folder": os.path.abspath(image_folder),
+            "render_kwargs": render_kwargs,
+            "package_mode": package_mode,
+            "files": [
+                {
+                    "image_path": os.path.abspath(image_path), "status": "pending", "output_path": None,
+                    "message": None, "packed": False,
+                }
+                for image_path in image_paths
+            ],
+        })
+        manifest.save()
+        return manifest
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as file:
+            data = json.load(file)
+        if data.get("version") != cls.version:
+            raise ValueError(f"Unknown batch manifest version: {data.get('version')}")
+        return cls(path, data)
+
+    @property
+    def render_kwargs(self):
+        return dict(self.data["render_kwargs"])
+
+    @property
+    def package_path(self):
+        """ The zip or folder of the videos, named like the manifest, in the video dir """
+        name = self.data["batch_id"]
+        if self.data.get("package_mode", "zip") == "zip":
+            name = f"{name}.zip"
+        return os.path.join(self.data["render_kwargs"]["save_path"], name)
+
+    def save(self):
+        # write & rename, a crash while saving keeps the previous manifest
+        temp_path = f"{self.path}.tmp"
+        with open(temp_path, "w") as file:
+            json.dump(self.data, file, indent=1)
+        os.replace(temp_path, self.path)
+
+    def mark(self, result):
+        """ Records a render_sketch result (with "image_path") & saves the manifest """
+        image_path = os.path.abspath(result["image_path"])
+        with self.lock:
+            for entry in self.data["files"]:
+                if entry["image_path"] == image_path:
+                    entry["status"] = "done" if result["status"] else "failed"
+                    entry["output_path"] = result["message"] if result["status"] else None
+                    entry["message"] = None if result["status"] else result["message"]
+                    entry["packed"] = False
+            self.save()
+
+    def mark_packed(self, video_path):
+        """ The video was moved into the package by BatchPackager """
+        with self.lock:
+            for entry in self.data["files"]:
+                if entry["output_path"] == video_path:
+                    entry["packed"] = True
+            self.save()
+
+    def unpack_all(self):
+        """ The package was lost, its videos have to be rendered again """
+        with self.lock:
+            for entry in self.data["files"]:
+                entry["packed"] = False
+            self.save()
+
+    def is_done(self, entry):
+        if entry["status"] != "done" or not entry["output_path"]:
+            return False
+        return entry.get("packed") or os.path.exists(entry["output_path"])
+
+    def done_files(self):
+        """ Videos of the finished images, packed or not """
+        return [entry["output_path"] for entry in self.data["files"] if self.is_done(entry)]
+
+    def unpacked_files(self):
+        """ Videos of the finished images which are not in the package yet """
+        return [
+            entry["output_path"] for entry in self.data["files"] if self.is_done(entry) and not entry.get("packed")
+        ]
+
+    def pending_paths(self):
+        """ Images still to render, failed ones are tried again """
+        return [entry["image_path"] for entry in self.data["files"] if not self.is_done(entry)]
+
+    def remove(self):
+        """ The batch is finished & its videos are packed, nothing to resume """
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+
+
+def find_resumable_batch(manifest_dir, image_folder=None):
+    """ The newest batch (of image_folder if given) whose manifest was not removed, or None """
+    if not os.path.isdir(manifest_dir):
+        return None
+    for file in sorted(os.listdir(manifest_dir), reverse=True):
+        if not file.endswith(".json"):
+            continue
+        try:
+            manifest = BatchManifest.load(os.path.join(manifest_dir, file))
+        except (OSError, ValueError) as e:
+            print(f"Skipping the batch manifest {file}: {e}")
+            continue
+        if image_folder and manifest.data["image_folder"] != os.path.abspath(image_folder):
+            continue
+        # also when all images are done, the app may have stopped before packing them
+        return manifest
+    return None
+
+
+class BatchPackager:
+    """
+    Packs the videos of a batch on its own thread while the batch is still
+    rendering: into a zip with stored entries (H.264 does not compress any
+    further) or, with mode "folder", moved into a plain folder. Each video
+    is removed once it is packed, so the disk holds only one extra copy of
+    one video at a time. The zip is closed after every video, so it stays
+    readable when the app stops halfway.
+    on_packed(video_path), on_progress(n_packed, n_added) and
+    on_done(package_path, n_packed) are called from the packing thread.
+    """
+
+    def __init__(self, package_path, mode="zip", on_packed=None, on_progress=None, on_done=None):
+        self.package_path = package_path
+        self.mode = mode
+        self.on_packed = on_packed
+        self.on_progress = on_progress
+        self.on_done = on_done
+        self.queue = queue.Queue()
+        self.n_added = 0
+        self.n_packed = 0
+        self.errors = []
+        self.thread = threading.Thread(target=self.run, name="batch-packager", daemon=True)
+        self.thread.start()
+
+    def add(self, video_path):
+        self.n_added += 1
+        self.queue.put(video_path)
+
+    def close(self):
+        """ Packs what was added & then calls on_done """
+        self.queue.put(None)
+
+    def pack(self, video_path):
+        if self.mode == "folder":
+            os.makedirs(self.package_path, exist_ok=True)
+            # a rename within the video dir, no copy
+            shutil.move(video_path, os.path.join(self.package_path, os.path.basename(video_path)))
+            return
+        zip_mode = "a" if os.path.exists(self.package_path) else "w"
+        with zipfile.ZipFile(self.package_path, zip_mode, compression=zipfile.ZIP_STORED, allowZip64=True) as zip_obj:
+            # written in chunks, the video is not read into memory
+            zip_obj.write(video_path, os.path.basename(video_path))
+        os.remove(video_path)
+
+    def run(self):
+        while True:
+            video_path = self.queue.get()
+            if video_path is None:
+                break
+            try:
+                self.pack(video_path)
+                self.n_packed += 1
+                if self.on_packed:
+                    self.on_packed(video_path)
+            except Exception as e:
+                print(f"Packing error: {video_path}: {e}")
+                self.errors.append((video_path, str(e)))
+            if self.on_progress:
+                self.on_progress(self.n_packed, self.n_added)
+        if self.on_done:
+            self.on_done(self.package_path, self.n_packed)
+
+
+def is_package_readable(package_path):
+    if not os.path.exists(package_path) or os.path.isdir(package_path):
+        return True
+    try:
+        with zipfile.ZipFile(package_path) as zip_obj:
+            zip_obj.namelist()
+        return True
+    except (OSError, zipfile.BadZipFile):
+        return False
+
+
+# progress of the running images & the stopped jobs, set in each worker process by init_batch_worker
+progress_queue = None
+cancel_flags = None
+
+
+def init_batch_worker(worker_progress_queue=None, worker_cancel_flags=None):
+    global progress_queue, cancel_flags
+    progress_queue = worker_progress_queue
+    cancel_flags = worker_cancel_flags
+    # the images are already rendered in parallel, no nested cv2 thread pools
+    cv2.setNumThreads(1)
+
+
+class JobCancelFlag:
+    """
+    The cancel_event of render_sketch in a worker process or thread: set
+    once the scheduler stops the job, see RenderScheduler.stop_job
+    """
+
+    def __init__(self, flags, slot):
+        self.flags = flags
+        self.slot = slot
+
+    def is_set(self):
+        return self.flags[self.slot] != 0
+
+
+def render_job_image(image_path, render_kwargs, progress_callback=None, cancel_event=None):
+    """
+    Renders one image of a job, uses the LabelMe JSON next to the image
+    unless use_sidecar_mask is False. The result has "image_path" added.
+    """
+    render_kwargs = dict(render_kwargs)
+    if render_kwargs.pop("use_sidecar_mask", True):
+        render_kwargs["mask_path"] = find_labelme_mask(image_path)
+    result = render_sketch(
+        image_path=image_path, progress_callback=progress_callback, cancel_event=cancel_event, **render_kwargs
+    )
+    result["image_path"] = image_path
+    return result
+
+
+def render_batch_image(image_path, render_kwargs, progress_key=None, cancel_slot=None):
+    """
+    Runs inside a worker process. With a progress_key the drawing progress
+    goes back to the scheduler as (progress_key, value). The render stops
+    early once the cancel_slot flag is set.
+    """
+    progress_callback = None
+    if progress_key is not None and progress_queue is not None:
+        progress_callback = lambda value: progress_queue.put((progress_key, value))
+    cancel_event = None
+    if cancel_slot is not None and cancel_flags is not None:
+        cancel_event = JobCancelFlag(cancel_flags, cancel_slot)
+    return render_job_image(image_path, render_kwargs, progress_callback, cancel_event)
+
+
+class RenderJob:
+    """
+    One submitted render of the RenderScheduler: a single image or all
+    images of a folder. `state` is "queued", "running", "done" or
+    "stopped". The callbacks are called from scheduler threads:
+    on_result(job, result) as each image finishes, on_progress(job, value)
+    with the drawing progress of single image jobs & on_done(job) once all
+    images are finished or the job is stopped.
+    """
+
+    def __init__(
+        self, job_id, image_paths, render_kwargs, priority=0, kind="batch", on_result=None, on_progress=None,
+        on_done=None, manifest=None, packager=None,
+    ):
+        self.job_id = job_id
+        self.image_paths = list(image_paths)
+        self.render_kwargs = dict(render_kwargs)
+        self.render_kwargs.pop("progress_callback", None)  # not picklable, see on_progress
+        self.priority = priority
+        self.kind = kind
+        self.on_result = on_result
+        self.on_progress = on_progress
+        self.on_done = on_done
+        self.manifest = manifest  # BatchManifest, gets every result
+        self.packager = packager  # BatchPackager, gets every video & is closed with the job
+        self.state = "queued"
+        self.finished = False  # on_done was called or is about to be
+        self.results = []
+        self.n_running = 0
+        self.n_queued = len(self.image_paths)
+        self.progress = 0
+        # workers an image of the job keeps busy: a segmented render runs a process per segment
+        self.image_workers = max(1, int(self.render_kwargs.get("segments") or 1))
+
+    @property
+    def n_done(self):
+        """ Finished images, with a video or failed """
+        return len(self.results) - self.n_cancelled
+
+    @property
+    def n_failed(self):
+        return sum(1 for result in self.results if not result["status"] and not result.get("cancelled"))
+
+    @property
+    def n_cancelled(self):
+        """ Images stopped by stop_job while they rendered """
+        return sum(1 for result in self.results if result.get("cancelled"))
+
+    def as_dict(self):
+        return {
+            "job_id": self.job_id,
+            "kind": self.kind,
+            "state": self.state,
+            "priority": self.priority,
+            "n_images": len(self.image_paths),
+            "n_done": self.n_done,
+            "n_failed": self.n_failed,
+            "n_cancelled": self.n_cancelled,
+            "n_running": self.n_running,
+            "progress": round(self.progress, 1),
+        }
+
+
+class RenderScheduler:
+    """
+    The render queue of the app: single images & folders are submitted as
+    jobs, their images are rendered in worker processes, at most `workers`
+    at a time. The next image is always taken from the job with the highest
+    priority (the oldest job first on a tie), so a single image submitted
+    during a batch starts as soon as a worker is free. Stopping a job also
+    cancels its running images, which frees their workers within a frame.
+    An image rendered in segments counts as a worker per segment, the
+    images after it wait until that many are free.
+    use_processes: worker processes on desktops, threads of the app process
+    on Android (forking the app there is not safe). Threads are also used
+    when the process pool can not be made.
+    """
+
+    # jobs share the cancel flags by job_id modulo this, far more than can run at once
+    n_cancel_slots = 1024
+
+    def __init__(self, workers=None, use_processes=None):
+        self.workers = max(1, int(workers or get_default_workers()))
+        self.use_processes = not is_android() if use_processes is None else use_processes
+        self.lock = threading.Lock()
+        self.jobs = []
+        self.heap = []
+        self.sequence = itertools.count()
+        self.n_running = 0  # busy workers, see RenderJob.image_workers
+        self.executor = None
+        self.progress_queue = None
+        self.cancel_flags = None
+        self.progress_thread = None
+        self.dispatching = False
+        self.dispatch_again = False
+        # pools that failed in submit_image, shut down by dispatch
+        self.broken_pools = []
+
+    def get_executor(self):
+        """ The pool is made on the first job. It has a worker per core, `workers` limits how many are busy """
+        if self.executor is None and self.use_processes:
+            try:
+                mp_context = get_mp_context()
+                self.progress_queue = mp_context.Queue()
+                # shared memory, the workers read it between frames without a lock
+                self.cancel_flags = mp_context.RawArray("b", self.n_cancel_slots)
+                self.executor = ProcessPoolExecutor(
+                    max_workers=max(self.workers, os.cpu_count() or 1),
+                    mp_context=mp_context,
+                    initializer=init_batch_worker,
+                    initargs=(self.progress_queue, self.cancel_flags),
+                )
+            except (OSError, ImportError, NotImplementedError) as e:
+                # no working semaphores, e.g. some Android builds
+                print(f"Render process pool is not available, using threads: {e}")
+                self.use_processes = False
+            else:
+                self.progress_thread = threading.Thread(target=self.read_progress, name="render-progress", daemon=True)
+                self.progress_thread.start()
+        if self.executor is None:
+            self.cancel_flags = bytearray(self.n_cancel_slots)
+            self.executor = ThreadPoolExecutor(
+                max_workers=max(self.workers, os.cpu_count() or 1), thread_name_prefix="render"
+            )
+        return self.executor
+
+    def set_workers(self, workers):
+        """ New concurrency limit, running images keep running """
+        with self.lock:
+            self.workers = max(1, int(workers))
+        self.dispatch()
+
+    def submit(
+        self, image_paths, render_kwargs, priority=0, kind="batch", on_result=None, on_progress=None, on_done=None,
+        manifest=None, packager=None,
+    ):
+        """ Queues the images as a new job & returns the RenderJob """
+        with self.lock:
+            # the id is the index in self.jobs + 1, see read_progress
+            job = RenderJob(
+                len(self.jobs) + 1, image_paths, render_kwargs, priority, kind, on_result, on_progress, on_done,
+                manifest, packager,
+            )
+            self.jobs.append(job)
+            if self.cancel_flags is not None:
+                # the slot of an old job
+                self.cancel_flags[self.get_cancel_slot(job)] = 0
+            for image_path in job.image_paths:
+                heapq.heappush(self.heap, (-priority, next(self.sequence), job, image_path))
+        if not job.image_paths:
+            job.finished = True
+            self.finish_job(job)
+        else:
+            self.dispatch()
+        return job
+
+    def dispatch(self):
+        """
+        Starts queued images while there are free workers. The done callbacks
+        are added after the lock is released: the callback of a future that
+        is already done (e.g. an image failing at once in a thread) runs right
+        away in add_done_callback & takes the lock. One thread dispatches at a
+        time, a dispatch from such a callback only makes it loop again.
+        """
+        with self.lock:
+            if self.dispatching:
+                self.dispatch_again = True
+                return
+            self.dispatching = True
+        try:
+            while True:
+                started = []
+                with self.lock:
+                    while self.heap:
+                        _, _, job, image_path = self.heap[0]
+                        if job.state == "stopped":
+                            heapq.heappop(self.heap)
+                            continue
+                        # an image needing more workers than there are runs alone
+                        if self.n_running and self.n_running + job.image_workers > self.workers:
+                            break
+                        heapq.heappop(self.heap)
+                        job.n_queued -= 1
+                        job.n_running += 1
+                        job.state = "running"
+                        self.n_running += job.image_workers
+                        future = self.submit_image(job, image_path)
+                        future.job = job
+                        future.image_path = image_path
+                        started.append(future)
+                    broken_pools, self.broken_pools = self.broken_pools, []
+                    if not started and not broken_pools and not self.dispatch_again:
+                        self.dispatching = False
+                        return
+                    self.dispatch_again = False
+                for executor, progress_queue, progress_thread in broken_pools:
+                    self.close_executor(executor, progress_queue, progress_thread)
+                for future in started:
+                    future.add_done_callback(self.image_done)
+        except BaseException:
+            with self.lock:
+                self.dispatching = False
+            raise
+
+    def submit_image(self, job, image_path):
+        """ Starts one image of the job on the pool, called with the lock held """
+        executor = self.get_executor()
+        if self.use_processes:
+            # progress is only shown for single images
+            progress_key = job.job_id if job.on_progress else None
+            try:
+                return executor.submit(
+                    render_batch_image, image_path, job.render_kwargs, progress_key, self.get_cancel_slot(job)
+                )
+            except (OSError, RuntimeError) as e:
+                # the workers could not be started (BrokenProcessPool is a RuntimeError),
+                # dispatch shuts the pool down once the lock is released
+                print(f"Render process pool failed, using threads: {e}")
+                self.broken_pools.append((self.executor, self.progress_queue, self.progress_thread))
+                self.executor = None
+                self.progress_queue = None
+                self.progress_thread = None
+                self.use_processes = False
+                executor = self.get_executor()
+        return executor.submit(
+            render_job_image, image_path, job.render_kwargs,
+            (lambda value: self.job_progress(job, value)) if job.on_progress else None,
+            JobCancelFlag(self.cancel_flags, self.get_cancel_slot(job)),
+        )
+
+    def get_cancel_slot(self, job):
+        return job.job_id % self.n_cancel_slots
+
+    def image_done(self, future):
+        job = future.job
+        try:
+            result = future.result()
+        except Exception as e:
+            result = {"status": False, "message": f"Error: {e}", "image_path": future.image_path}
+        # a cancelled image stays pending in the manifest, it is rendered again on resume
+        if job.manifest is not None and not result.get("cancelled"):
+            try:
+                job.manifest.mark(result)
+            except OSError as e:
+                print(f"Batch manifest error: {e}")
+        if job.packager is not None and result["status"]:
+            job.packager.add(result["message"])
+        with self.lock:
+            job.results.append(result)
+            job.n_running -= 1
+            self.n_running -= job.image_workers
+            job_done = not job.finished and job.n_running == 0 and (job.n_queued == 0 or job.state == "stopped")
+            job.finished = job.finished or job_done
+        if job.on_result:
+            job.on_result(job, result)
+        if job_done:
+            self.finish_job(job)
+        self.dispatch()
+
+    def finish_job(self, job):
+        if job.state != "stopped":
+            job.state = "done"
+        if job.packager is not None:
+            job.packager.close()
+        if job.on_done:
+            job.on_done(job)
+
+    def stop_job(self, job):
+        """ Drops the images of the job not started yet & cancels the running ones """
+        with self.lock:
+            if job.finished or job.state == "stopped":
+                return
+            job.state = "stopped"
+            # the heap entries are skipped by dispatch
+            job.n_queued = 0
+            if job.n_running and self.cancel_flags is not None:
+                self.cancel_flags[self.get_cancel_slot(job)] = 1
+            job_done = job.n_running == 0
+            job.finished = job_done
+        if job_done:
+            self.finish_job(job)
+
+    def read_progress(self):
+        """ Progress thread: forwards (job_id, value) from the workers to on_progress """
+        progress_queue = self.progress_queue
+        while True:
+            item = progress_queue.get()
+            if item is None:
+                break
+            job_id, value = item
+            self.job_progress(self.jobs[job_id - 1], value)
+
+    def job_progress(self, job, value):
+        job.progress = value
+        if job.on_progress:
+            job.on_progress(job, value)
+
+    def get_jobs(self):
+        """ State of every job, see RenderJob.as_dict """
+        with self.lock:
+            return [job.as_dict() for job in self.jobs]
+
+    def is_busy(self):
+        with self.lock:
+            return self.n_running > 0 or any(job.state in ("queued", "running") for job in self.jobs)
+
+    def shutdown(self, wait=False):
+        for job in list(self.jobs):
+            self.stop_job(job)
+        self.shutdown_executor(wait)
+
+    def shutdown_executor(self, wait=False):
+        executor, progress_queue, progress_thread = self.executor, self.progress_queue, self.progress_thread
+        self.executor = None
+        self.progress_queue = None
+        self.progress_thread = None
+        self.close_executor(executor, progress_queue, progress_thread, wait)
+
+    @staticmethod
+    def close_executor(executor, progress_queue, progress_thread, wait=False):
+        if executor is not None:
+            executor.shutdown(wait=wait, cancel_futures=True)
+        if progress_queue is not None:
+            # ends read_progress
+            progress_queue.put(None)
+            if wait and progress_thread is not None:
+                # before the queue is closed at exit
+                progress_thread.join()
+
+
+class BatchRenderer:
+    """
+    Renders many images at once in worker processes, a RenderScheduler
+    with a single job. on_result(result) is called as each image finishes &
+    on_done(results) once all are finished or stopped. Both run on a pool
+    helper thread, not on the caller's thread. The result dicts are the ones
+    from render_sketch plus "image_path". A `manifest` (BatchManifest) gets
+    every result before on_result is called, except the ones cancelled by
+    `stop`, those images stay pending. `close` ends the workers once it is
+    done.
+    """
+
+    def __init__(self, image_paths, render_kwargs, workers=None, on_result=None, on_done=None, manifest=None):
+        self.image_paths = list(image_paths)
+        self.render_kwargs = dict(render_kwargs)
+        self.on_result = on_result
+        self.on_done = on_done
+        self.manifest = manifest
+        self.scheduler = RenderScheduler(min(max(1, int(workers or get_default_workers())), max(1, len(self.image_paths))))
+        self.job = None
+
+    @property
+    def results(self):
+        return self.job.results if self.job else []
+
+    @property
+    def stopped(self):
+        return self.job is not None and self.job.state == "stopped"
+
+    def start(self):
+        self.job = self.scheduler.submit(
+            self.image_paths,
+            self.render_kwargs,
+            on_result=lambda job, result: self.on_result and self.on_result(result),
+            on_done=self.job_done,
+            manifest=self.manifest,
+        )
+
+    def job_done(self, job):
+        # runs on a pool thread, the caller shuts the pool down with close
+        if self.on_done:
+            self.on_done(job.results)
+
+    def stop(self):
+        """ Drops the images not started yet & cancels the running ones, their partial videos are deleted """
+        if self.job is not None:
+            self.scheduler.stop_job(self.job)
+
+    def close(self):
+        """ Stops the batch & waits for the workers to exit, call it from the thread that started it """
+        self.scheduler.shutdown(wait=True)